@@ -233,7 +233,8 @@ class ImageGenerationService:
             model_name: Название модели (если None, используется текущая)
 
         Returns:
-            (image_bytes, metadata)
+            (image_bytes, metadata) — сырые PNG-байты, пригодные для прямой
+            загрузки в Telegram без декодирования через PIL
         """
         start_time = datetime.now()
         model_name = model_name or self.current_model
@@ -2,6 +2,7 @@
 Система логирования для бота VoiceSticker
 """
 import sys
+from asyncio import iscoroutinefunction as _iscoroutinefunction
 from pathlib import Path
 from loguru import logger
 from config import LOG_LEVEL, LOG_FILE, LOGS_DIR
@@ -17,38 +18,62 @@ log_format = (
     "<level>{message}</level>"
 )
 
+# Для файловых sink'ов цветовая разметка все равно вырезается —
+# используем формат без тегов, чтобы не платить за их разбор на каждую запись
+file_format = (
+    "{time:YYYY-MM-DD HH:mm:ss} | "
+    "{level: <8} | "
+    "{name}:{function}:{line} | "
+    "{message}"
+)
+
 # Добавляем вывод в консоль
+# Цвет включаем только для интерактивного терминала: в контейнере/systemd
+# ANSI-разметка — лишняя работа на каждую запись
 logger.add(
     sys.stdout,
     format=log_format,
     level=LOG_LEVEL,
-    colorize=True,
+    colorize=sys.stdout.isatty(),
 )
 
 # Добавляем запись в файл
+# enqueue=True переносит запись и сжатие в фоновый поток — вызывающая
+# корутина не блокируется на файловом I/O
 logger.add(
     LOG_FILE,
-    format=log_format,
+    format=file_format,
     level=LOG_LEVEL,
     rotation="1 day",  # Новый файл каждый день
     retention="7 days",  # Хранить логи 7 дней
     compression="zip",  # Сжимать старые логи
     encoding="utf-8",
+    enqueue=True,
+    backtrace=False,
+    diagnose=False,
 )
 
 # Создаем отдельный файл для ошибок
 error_log_file = LOGS_DIR / "errors.log"
 logger.add(
     error_log_file,
-    format=log_format,
+    format=file_format,
     level="ERROR",
     rotation="1 week",
     retention="1 month",
     compression="zip",
     encoding="utf-8",
+    enqueue=True,
+    backtrace=False,
+    diagnose=False,
 )
 
 
+# Номера уровней для быстрой проверки "будет ли запись вообще принята"
+_INFO_LEVEL = logger.level("INFO").no
+_ERROR_LEVEL = logger.level("ERROR").no
+
+
 # Функция для логирования с контекстом пользователя
 def log_user_action(user_id: int, action: str, details: dict = None):
     """
@@ -59,14 +84,18 @@ def log_user_action(user_id: int, action: str, details: dict = None):
         action: Название действия
         details: Дополнительные детали
     """
-    context = {
-        "user_id": user_id,
-        "action": action,
-    }
-    if details:
-        context.update(details)
+    # Не собираем контекст, если INFO все равно отфильтрован
+    if logger._core.min_level > _INFO_LEVEL:
+        return
+
+    logger.bind(user_id=user_id, action=action, **(details or {})).info(
+        "User action: {}", action
+    )
+
 
-    logger.info(f"User action: {action}", **context)
+# Проверяем один раз при настройке: принимает ли хоть один sink уровень DEBUG.
+# Если нет — декоратор не должен тратить время на repr аргументов при каждом вызове
+_DEBUG_LOGGING = logger._core.min_level <= 10
 
 
 # Декоратор для логирования функций
@@ -74,7 +103,12 @@ def log_function(func):
     """Декоратор для автоматического логирования вызовов функций"""
 
     async def async_wrapper(*args, **kwargs):
-        logger.debug(f"Calling {func.__name__} with args={args}, kwargs={kwargs}")
+        if not _DEBUG_LOGGING:
+            return await func(*args, **kwargs)
+        logger.opt(lazy=True).debug(
+            "Calling {} with args={}, kwargs={}",
+            lambda: func.__name__, lambda: args, lambda: kwargs
+        )
         try:
             result = await func(*args, **kwargs)
             logger.debug(f"{func.__name__} completed successfully")
@@ -84,7 +118,12 @@ def log_function(func):
             raise
 
     def sync_wrapper(*args, **kwargs):
-        logger.debug(f"Calling {func.__name__} with args={args}, kwargs={kwargs}")
+        if not _DEBUG_LOGGING:
+            return func(*args, **kwargs)
+        logger.opt(lazy=True).debug(
+            "Calling {} with args={}, kwargs={}",
+            lambda: func.__name__, lambda: args, lambda: kwargs
+        )
         try:
             result = func(*args, **kwargs)
             logger.debug(f"{func.__name__} completed successfully")
@@ -94,8 +133,7 @@ def log_function(func):
             raise
 
     # Возвращаем правильный wrapper в зависимости от типа функции
-    import asyncio
-    if asyncio.iscoroutinefunction(func):
+    if _iscoroutinefunction(func):
         return async_wrapper
     else:
         return sync_wrapper
@@ -110,15 +148,15 @@ def log_error(error: Exception, context: dict = None):
         error: Объект исключения
         context: Дополнительный контекст
     """
-    error_info = {
-        "error_type": type(error).__name__,
-        "error_message": str(error),
-        "traceback": True,
-    }
-    if context:
-        error_info.update(context)
-
-    logger.error(f"Error occurred: {error_info['error_type']}", **error_info)
+    # Не собираем контекст, если ERROR все равно отфильтрован
+    if logger._core.min_level > _ERROR_LEVEL:
+        return
+
+    # opt(exception=...) заставляет loguru самому отформатировать traceback —
+    # лениво и без сборки промежуточного словаря на каждом вызове
+    logger.opt(exception=error).bind(**(context or {})).error(
+        "Error occurred: {}", type(error).__name__
+    )
 
 
 # Экспортируем logger для использования в других модулях
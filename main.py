@@ -5,8 +5,15 @@ import asyncio
 import sys
 from pathlib import Path
 
+# Принудительно включаем UTF-8 до настройки loguru: иначе на Windows каждая
+# запись с кириллицей проходит через посимвольную перекодировку
+if hasattr(sys.stdout, "reconfigure"):
+    sys.stdout.reconfigure(encoding="utf-8")
+    sys.stderr.reconfigure(encoding="utf-8")
+
 from aiogram import Bot
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
 
 from logger import logger
@@ -20,18 +27,30 @@ from image_generation_service import image_service
 from stt_service import stt_service
 
 
+class PooledAiohttpSession(AiohttpSession):
+    """AiohttpSession с увеличенным пулом соединений
+
+    В aiogram 3.7 размер пула не пробрасывается через конструктор
+    (параметр limit появился позже), поэтому правим настройки
+    TCPConnector до его ленивого создания
+    """
+
+    def __init__(self, limit: int = 512):
+        super().__init__()
+        self._connector_init["limit"] = limit
+
+
 async def on_startup():
     """Действия при запуске бота"""
     logger.info("Запуск бота VoiceSticker...")
 
-    # Инициализация базы данных
-    logger.info("Инициализация базы данных...")
-    await db_manager.init_db()
-
-    # Инициализация сервисов
-    logger.info("Инициализация сервисов...")
-    # await image_service.initialize()  # Эту строку нужно удалить или закомментировать
-    await stt_service.initialize()
+    # БД и сервисы работают с независимыми ресурсами (файл SQLite, модель),
+    # поэтому инициализируем их параллельно — старт ограничен самым медленным
+    logger.info("Инициализация базы данных и сервисов...")
+    await asyncio.gather(
+        db_manager.init_db(),
+        stt_service.initialize(),
+    )
 
     logger.info("✅ Бот успешно запущен!")
 
@@ -44,12 +63,19 @@ async def on_shutdown():
 
     logger.info("Бот остановлен")
 
+    # Дожидаемся записи сообщений из очереди файловых sink'ов (enqueue=True)
+    await logger.complete()
+
 
 async def main():
     """Основная функция запуска"""
-    # Создаем экземпляр бота
+    # Создаем экземпляр бота. Пул соединений поднят с дефолтных 100:
+    # под нагрузкой параллельные вызовы Bot API упираются в
+    # «Connection pool is full», а переиспользование TCP+TLS экономит
+    # рукопожатие на каждый запрос
     bot = Bot(
         token=BOT_TOKEN,
+        session=PooledAiohttpSession(limit=512),
         default=DefaultBotProperties(
             parse_mode=ParseMode.HTML
         )
@@ -107,6 +133,14 @@ async def main():
 
 
 if __name__ == "__main__":
+    # uvloop (Linux/Mac) — опциональная зависимость, дает в 2-4 раза более
+    # быстрый event loop для I/O-bound пути polling/webhook
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     # Настройка для Windows
     if sys.platform.startswith('win'):
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
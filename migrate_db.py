@@ -6,29 +6,54 @@
 - Таблицы для стикерпаков
 """
 import asyncio
+import sys
 import aiosqlite
 from pathlib import Path
 from datetime import datetime
 
+# Статусные сообщения копим в буфере и пишем в stdout одной записью,
+# вместо десятков построчных вызовов print (syscall на каждую строку)
+_output = []
+
+
+def say(message=""):
+    """Добавляет статусное сообщение в буфер вывода"""
+    _output.append(message)
+
+
+def flush_output():
+    """Пишет накопленные сообщения в stdout одним вызовом"""
+    if _output:
+        sys.stdout.write("\n".join(_output) + "\n")
+        sys.stdout.flush()
+        _output.clear()
+
+
+# Кэш PRAGMA table_info: один запрос на таблицу вместо запроса на каждую колонку
+_table_columns = {}
+
 
 async def check_column_exists(db, table: str, column: str) -> bool:
     """Проверяет существование колонки в таблице"""
-    try:
-        cursor = await db.execute(f"PRAGMA table_info({table})")
-        columns = await cursor.fetchall()
-        return any(col[1] == column for col in columns)
-    except:
-        return False
+    if table not in _table_columns:
+        try:
+            cursor = await db.execute(f"PRAGMA table_info({table})")
+            columns = await cursor.fetchall()
+            _table_columns[table] = {col[1] for col in columns}
+        except:
+            return False
+    return column in _table_columns[table]
+
 
+async def load_existing(db) -> set:
+    """Загружает имена всех таблиц и представлений одним запросом
 
-async def check_table_exists(db, table: str) -> bool:
-    """Проверяет существование таблицы"""
-    cursor = await db.execute(
-        "SELECT name FROM sqlite_master WHERE type='table' AND name=?",
-        (table,)
-    )
-    result = await cursor.fetchone()
-    return result is not None
+    Возвращает множество строк вида 'table:stickers' / 'view:pack_statistics' —
+    дальнейшие проверки существования не требуют обращений к БД.
+    """
+    cursor = await db.execute("SELECT type || ':' || name FROM sqlite_master")
+    rows = await cursor.fetchall()
+    return {row[0] for row in rows}
 
 
 async def migrate_database():
@@ -47,23 +72,32 @@ async def migrate_database():
             break
 
     if not db_path:
-        print("❌ База данных не найдена!")
-        print("Проверьте наличие файла: bot_database.db, voicesticker.db или database.db")
+        say("❌ База данных не найдена!")
+        say("Проверьте наличие файла: bot_database.db, voicesticker.db или database.db")
         return
 
-    print(f"🔄 Начинаю миграцию базы данных: {db_path}")
-    print(f"📅 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+    say(f"🔄 Начинаю миграцию базы данных: {db_path}")
+    say(f"📅 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
 
     async with aiosqlite.connect(db_path) as db:
         # Включаем поддержку внешних ключей
         await db.execute("PRAGMA foreign_keys = ON")
 
+        # Инвентаризацию схемы выполняем параллельно: соединения SQLite легкие,
+        # второе соединение на чтение позволяет не стоять в очереди первого
+        async with aiosqlite.connect(db_path) as ro:
+            existing, sticker_columns = await asyncio.gather(
+                load_existing(db),
+                ro.execute_fetchall("PRAGMA table_info(stickers)"),
+            )
+        _table_columns["stickers"] = {col[1] for col in sticker_columns}
+
         # ========== МИГРАЦИЯ СУЩЕСТВУЮЩИХ ТАБЛИЦ ==========
-        print("📋 Проверяю существующие таблицы...")
+        say("📋 Проверяю существующие таблицы...")
 
         # Проверяем и добавляем колонки в таблицу stickers
-        if await check_table_exists(db, "stickers"):
-            print("\n🔧 Обновляю таблицу stickers...")
+        if "table:stickers" in existing:
+            say("\n🔧 Обновляю таблицу stickers...")
 
             columns_to_add = [
                 ("rating", "INTEGER DEFAULT NULL"),
@@ -73,21 +107,21 @@ async def migrate_database():
 
             for column_name, column_def in columns_to_add:
                 if not await check_column_exists(db, "stickers", column_name):
-                    print(f"  ➕ Добавляю колонку {column_name}...")
+                    say(f"  ➕ Добавляю колонку {column_name}...")
                     try:
                         await db.execute(f"ALTER TABLE stickers ADD COLUMN {column_name} {column_def}")
-                        print(f"  ✅ Колонка {column_name} добавлена")
+                        say(f"  ✅ Колонка {column_name} добавлена")
                     except Exception as e:
-                        print(f"  ⚠️  Ошибка при добавлении {column_name}: {e}")
+                        say(f"  ⚠️  Ошибка при добавлении {column_name}: {e}")
                 else:
-                    print(f"  ✔️  Колонка {column_name} уже существует")
+                    say(f"  ✔️  Колонка {column_name} уже существует")
 
         # ========== СОЗДАНИЕ НОВЫХ ТАБЛИЦ ДЛЯ СТИКЕРПАКОВ ==========
-        print("\n📦 Создаю таблицы для стикерпаков...")
+        say("\n📦 Создаю таблицы для стикерпаков...")
 
         # Таблица стикерпаков
-        if not await check_table_exists(db, "user_sticker_packs"):
-            print("  ➕ Создаю таблицу user_sticker_packs...")
+        if "table:user_sticker_packs" not in existing:
+            say("  ➕ Создаю таблицу user_sticker_packs...")
             await db.execute("""
                 CREATE TABLE user_sticker_packs (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -99,13 +133,14 @@ async def migrate_database():
                     FOREIGN KEY (user_id) REFERENCES users (user_id)
                 )
             """)
-            print("  ✅ Таблица user_sticker_packs создана")
+            existing.add("table:user_sticker_packs")
+            say("  ✅ Таблица user_sticker_packs создана")
         else:
-            print("  ✔️  Таблица user_sticker_packs уже существует")
+            say("  ✔️  Таблица user_sticker_packs уже существует")
 
         # Таблица связей стикеров с паками
-        if not await check_table_exists(db, "sticker_pack_items"):
-            print("  ➕ Создаю таблицу sticker_pack_items...")
+        if "table:sticker_pack_items" not in existing:
+            say("  ➕ Создаю таблицу sticker_pack_items...")
             await db.execute("""
                 CREATE TABLE sticker_pack_items (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -117,12 +152,13 @@ async def migrate_database():
                     UNIQUE(pack_id, sticker_id)
                 )
             """)
-            print("  ✅ Таблица sticker_pack_items создана")
+            existing.add("table:sticker_pack_items")
+            say("  ✅ Таблица sticker_pack_items создана")
         else:
-            print("  ✔️  Таблица sticker_pack_items уже существует")
+            say("  ✔️  Таблица sticker_pack_items уже существует")
 
         # ========== СОЗДАНИЕ ИНДЕКСОВ ==========
-        print("\n📊 Создаю индексы...")
+        say("\n📊 Создаю индексы...")
 
         indices = [
             ("idx_stickers_rating", "stickers(rating)", "stickers"),
@@ -132,33 +168,25 @@ async def migrate_database():
         ]
 
         for index_name, index_def, table_name in indices:
-            if await check_table_exists(db, table_name):
+            if f"table:{table_name}" in existing:
                 try:
                     await db.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {index_def}")
-                    print(f"  ✅ Индекс {index_name} создан или обновлен")
+                    say(f"  ✅ Индекс {index_name} создан или обновлен")
                 except Exception as e:
-                    print(f"  ⚠️  Ошибка при создании индекса {index_name}: {e}")
+                    say(f"  ⚠️  Ошибка при создании индекса {index_name}: {e}")
 
         # ========== СОЗДАНИЕ ПРЕДСТАВЛЕНИЙ ==========
-        print("\n📈 Создаю представления для аналитики...")
-
-        # Удаляем старые представления (если есть) для обновления
-        views_to_create = [
-            "sticker_quality_stats",
-            "style_performance",
-            "pack_statistics",
-            "user_pack_summary"
-        ]
+        say("\n📈 Создаю представления для аналитики...")
 
-        for view_name in views_to_create:
-            try:
-                await db.execute(f"DROP VIEW IF EXISTS {view_name}")
-            except:
-                pass
+        # Статический DDL отправляем одним executescript, чтобы не платить
+        # переключение в рабочий поток aiosqlite за каждое выражение
+        await db.executescript("""
+            DROP VIEW IF EXISTS sticker_quality_stats;
+            DROP VIEW IF EXISTS style_performance;
+            DROP VIEW IF EXISTS pack_statistics;
+            DROP VIEW IF EXISTS user_pack_summary;
 
-        # Представление для качества стикеров
-        await db.execute("""
-            CREATE VIEW IF NOT EXISTS sticker_quality_stats AS
+            CREATE VIEW sticker_quality_stats AS
             SELECT 
                 u.user_id,
                 u.username,
@@ -169,13 +197,9 @@ async def migrate_database():
                 COUNT(CASE WHEN s.rating <= 2 THEN 1 END) as poor_stickers
             FROM users u
             LEFT JOIN stickers s ON u.user_id = s.user_id AND s.is_deleted = 0
-            GROUP BY u.user_id
-        """)
-        print("  ✅ Представление sticker_quality_stats создано")
+            GROUP BY u.user_id;
 
-        # Представление для анализа стилей
-        await db.execute("""
-            CREATE VIEW IF NOT EXISTS style_performance AS
+            CREATE VIEW style_performance AS
             SELECT 
                 style,
                 COUNT(*) as total_generated,
@@ -186,13 +210,9 @@ async def migrate_database():
             FROM stickers
             WHERE rating IS NOT NULL AND is_deleted = 0
             GROUP BY style
-            ORDER BY avg_rating DESC
-        """)
-        print("  ✅ Представление style_performance создано")
+            ORDER BY avg_rating DESC;
 
-        # Представление для статистики паков
-        await db.execute("""
-            CREATE VIEW IF NOT EXISTS pack_statistics AS
+            CREATE VIEW pack_statistics AS
             SELECT 
                 p.id as pack_id,
                 p.user_id,
@@ -203,13 +223,9 @@ async def migrate_database():
                 p.updated_at
             FROM user_sticker_packs p
             LEFT JOIN sticker_pack_items spi ON p.id = spi.pack_id
-            GROUP BY p.id
-        """)
-        print("  ✅ Представление pack_statistics создано")
+            GROUP BY p.id;
 
-        # Представление для сводки по пользователям
-        await db.execute("""
-            CREATE VIEW IF NOT EXISTS user_pack_summary AS
+            CREATE VIEW user_pack_summary AS
             SELECT 
                 u.user_id,
                 u.username,
@@ -219,53 +235,94 @@ async def migrate_database():
             FROM users u
             LEFT JOIN user_sticker_packs p ON u.user_id = p.user_id
             LEFT JOIN sticker_pack_items spi ON p.id = spi.pack_id
-            GROUP BY u.user_id
+            GROUP BY u.user_id;
+        """)
+        say("  ✅ Созданы представления: sticker_quality_stats, style_performance, "
+            "pack_statistics, user_pack_summary")
+
+        # ========== МАТЕРИАЛИЗАЦИЯ АНАЛИТИКИ ==========
+        # style_performance читается многократно, а представление сканирует всю
+        # таблицу stickers при каждом SELECT. Материализуем в обычную таблицу
+        # и поддерживаем актуальность триггерами (пересчет только своего стиля);
+        # представление остается как запасной вариант
+        say("\n📦 Материализую style_performance...")
+        await db.executescript("""
+            DROP TABLE IF EXISTS mv_style_performance;
+            CREATE TABLE mv_style_performance AS
+            SELECT * FROM style_performance;
+
+            DROP TRIGGER IF EXISTS trg_style_perf_insert;
+            CREATE TRIGGER trg_style_perf_insert
+            AFTER INSERT ON stickers
+            WHEN NEW.rating IS NOT NULL
+            BEGIN
+                DELETE FROM mv_style_performance WHERE style = NEW.style;
+                INSERT INTO mv_style_performance
+                SELECT * FROM style_performance WHERE style = NEW.style;
+            END;
+
+            DROP TRIGGER IF EXISTS trg_style_perf_update;
+            CREATE TRIGGER trg_style_perf_update
+            AFTER UPDATE OF rating, is_deleted ON stickers
+            BEGIN
+                DELETE FROM mv_style_performance WHERE style = NEW.style;
+                INSERT INTO mv_style_performance
+                SELECT * FROM style_performance WHERE style = NEW.style;
+            END;
         """)
-        print("  ✅ Представление user_pack_summary создано")
+        say("  ✅ Таблица mv_style_performance и триггеры обновления созданы")
+
+        # Обновляем статистику планировщика, чтобы новые индексы реально
+        # использовались, а не отбрасывались по эвристическим оценкам
+        await db.execute("ANALYZE")
+        await db.execute("PRAGMA optimize")
 
         await db.commit()
 
         # ========== ПОКАЗЫВАЕМ ИТОГОВУЮ СТРУКТУРУ ==========
-        print("\n✅ Миграция завершена успешно!")
+        say("\n✅ Миграция завершена успешно!")
 
         # Показываем структуру основных таблиц
-        print("\n📋 Структура обновленных таблиц:")
+        say("\n📋 Структура обновленных таблиц:")
 
         tables_to_show = ["stickers", "user_sticker_packs", "sticker_pack_items"]
 
         for table_name in tables_to_show:
-            if await check_table_exists(db, table_name):
-                print(f"\n🔹 Таблица {table_name}:")
+            if f"table:{table_name}" in existing:
+                say(f"\n🔹 Таблица {table_name}:")
                 cursor = await db.execute(f"PRAGMA table_info({table_name})")
                 columns = await cursor.fetchall()
                 for col in columns:
                     nullable = "" if col[3] else " NOT NULL"
                     default = f" DEFAULT {col[4]}" if col[4] is not None else ""
-                    print(f"  - {col[1]} ({col[2]}{nullable}{default})")
+                    say(f"  - {col[1]} ({col[2]}{nullable}{default})")
 
         # Показываем статистику
-        print("\n📊 Статистика базы данных:")
+        say("\n📊 Статистика базы данных:")
 
         # Количество пользователей
         cursor = await db.execute("SELECT COUNT(*) FROM users")
         users_count = (await cursor.fetchone())[0]
-        print(f"  👥 Пользователей: {users_count}")
+        say(f"  👥 Пользователей: {users_count}")
 
         # Количество стикеров
-        if await check_table_exists(db, "stickers"):
+        if "table:stickers" in existing:
             cursor = await db.execute("SELECT COUNT(*) FROM stickers WHERE is_deleted = 0")
             stickers_count = (await cursor.fetchone())[0]
-            print(f"  🎨 Стикеров: {stickers_count}")
+            say(f"  🎨 Стикеров: {stickers_count}")
 
         # Количество паков
-        if await check_table_exists(db, "user_sticker_packs"):
+        if "table:user_sticker_packs" in existing:
             cursor = await db.execute("SELECT COUNT(*) FROM user_sticker_packs")
             packs_count = (await cursor.fetchone())[0]
-            print(f"  📦 Стикерпаков: {packs_count}")
+            say(f"  📦 Стикерпаков: {packs_count}")
 
-        print("\n✨ Все готово для работы со стикерпаками!")
-        print("💡 Не забудьте обновить config.py с именем вашего бота (BOT_USERNAME)")
+        say("\n✨ Все готово для работы со стикерпаками!")
+        say("💡 Не забудьте обновить config.py с именем вашего бота (BOT_USERNAME)")
 
 
 if __name__ == "__main__":
-    asyncio.run(migrate_database())
\ No newline at end of file
+    try:
+        asyncio.run(migrate_database())
+    finally:
+        flush_output()
\ No newline at end of file
@@ -3,10 +3,37 @@
 Скрипт миграции для внедрения умной генерации фонов
 """
 import asyncio
+import sys
 import aiosqlite
 from pathlib import Path
 from datetime import datetime
 
+# Статусные сообщения копим в буфере и пишем в stdout одной записью,
+# вместо десятков построчных вызовов print (syscall на каждую строку)
+_output = []
+
+
+def say(message=""):
+    """Добавляет статусное сообщение в буфер вывода"""
+    _output.append(message)
+
+
+def flush_output():
+    """Пишет накопленные сообщения в stdout одним вызовом"""
+    if _output:
+        sys.stdout.write("\n".join(_output) + "\n")
+        sys.stdout.flush()
+        _output.clear()
+
+
+# Ключевые слова локаций в промптах — единственный источник для SQL-предиката,
+# чтобы список не дублировался по тексту запросов
+LOCATION_KEYWORDS = (
+    "космос", "space", "лес", "forest", "море", "sea",
+    "город", "city", "офис", "office", "парк", "park",
+)
+LOCATION_PREDICATE = " OR ".join(f"prompt LIKE '%{word}%'" for word in LOCATION_KEYWORDS)
+
 
 async def migrate_smart_backgrounds():
     """Выполняет миграцию для умной генерации фонов"""
@@ -24,35 +51,79 @@ async def migrate_smart_backgrounds():
             break
 
     if not db_path:
-        print("❌ База данных не найдена!")
+        say("❌ База данных не найдена!")
         return
 
-    print(f"🔄 Начинаю миграцию базы данных: {db_path}")
-    print(f"📅 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    print("\n🎯 Цель: внедрение умной генерации фонов\n")
+    say(f"🔄 Начинаю миграцию базы данных: {db_path}")
+    say(f"📅 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    say("\n🎯 Цель: внедрение умной генерации фонов\n")
 
     async with aiosqlite.connect(db_path) as db:
         # Обновляем существующие записи
-        print("🔧 Обновляю типы фонов...")
+        say("🔧 Обновляю типы фонов...")
 
-        # Помечаем все существующие как auto_generated
-        await db.execute("""
-            UPDATE stickers 
-            SET background = 'auto_generated' 
-            WHERE background IS NOT NULL
+        # Помечаем все существующие как auto_generated.
+        # На повторном запуске UPDATE пропускаем: иначе каждая строка
+        # переписывается заново (грязные страницы + WAL) без пользы
+        cursor = await db.execute("""
+            SELECT 1 FROM stickers
+            WHERE background IS NOT NULL AND background <> 'auto_generated'
+            LIMIT 1
         """)
+        if await cursor.fetchone():
+            await db.execute("""
+                UPDATE stickers
+                SET background = 'auto_generated'
+                WHERE background IS NOT NULL AND background <> 'auto_generated'
+            """)
+            say("  ✅ Существующие стикеры обновлены")
+        else:
+            say("  ✔️  Стикеры уже мигрированы, пропускаю")
+
+        # Материализуем признак локации в промпте, чтобы представления
+        # не выполняли LIKE-сканирование всей таблицы при каждом запросе.
+        # VIRTUAL generated column: выражение описано один раз в схеме и
+        # вычисляется для новых строк само — код вставки в приложении про
+        # колонку не знает, и обычная колонка копила бы NULL после миграции
+        say("\n🔧 Добавляю колонку is_location...")
+        try:
+            await db.execute(f"""
+                ALTER TABLE stickers ADD COLUMN is_location INTEGER
+                GENERATED ALWAYS AS (
+                    CASE WHEN {LOCATION_PREDICATE} THEN 1 ELSE 0 END
+                ) VIRTUAL
+            """)
+        except aiosqlite.OperationalError as e:
+            if "duplicate column" not in str(e):
+                raise
+            # Колонка уже есть. Если это обычная колонка от прошлой версии
+            # миграции — дозаполняем накопившиеся NULL; для generated-колонки
+            # UPDATE запрещен и не требуется
+            try:
+                await db.execute(f"""
+                    UPDATE stickers
+                    SET is_location = CASE WHEN {LOCATION_PREDICATE} THEN 1 ELSE 0 END
+                    WHERE is_location IS NULL
+                """)
+            except aiosqlite.OperationalError:
+                pass
 
-        print("  ✅ Существующие стикеры обновлены")
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_stickers_is_location
+            ON stickers(is_location)
+        """)
+        say("  ✅ Колонка is_location заполнена и проиндексирована")
 
         # Создаем новые представления
-        print("\n📊 Создаю представления для аналитики...")
+        say("\n📊 Создаю представления для аналитики...")
 
-        # Удаляем старые представления если есть
-        await db.execute("DROP VIEW IF EXISTS generation_type_stats")
-        await db.execute("DROP VIEW IF EXISTS style_background_correlation")
+        # Статический DDL отправляем одним executescript: каждый отдельный
+        # await db.execute(...) в aiosqlite — это переключение в рабочий поток
+        await db.executescript("""
+            DROP VIEW IF EXISTS generation_type_stats;
+            DROP VIEW IF EXISTS style_background_correlation;
+            DROP VIEW IF EXISTS location_prompt_analysis;
 
-        # Статистика по типам генерации
-        await db.execute("""
             CREATE VIEW generation_type_stats AS
             SELECT 
                 CASE 
@@ -65,12 +136,8 @@ async def migrate_smart_backgrounds():
                 COUNT(CASE WHEN rating >= 4 THEN 1 END) * 100.0 / COUNT(rating) as success_rate
             FROM stickers
             WHERE is_deleted = 0
-            GROUP BY generation_type
-        """)
-        print("  ✅ Создано представление generation_type_stats")
+            GROUP BY generation_type;
 
-        # Корреляция стиля и типа фона
-        await db.execute("""
             CREATE VIEW style_background_correlation AS
             SELECT 
                 style,
@@ -81,42 +148,28 @@ async def migrate_smart_backgrounds():
             FROM stickers
             WHERE is_deleted = 0 AND rating IS NOT NULL
             GROUP BY style, background
-            ORDER BY style, count DESC
-        """)
-        print("  ✅ Создано представление style_background_correlation")
+            ORDER BY style, count DESC;
 
-        # Анализ промптов с локациями
-        await db.execute("""
             CREATE VIEW location_prompt_analysis AS
-            SELECT 
+            SELECT
                 COUNT(*) as total,
-                COUNT(CASE 
-                    WHEN prompt LIKE '%космос%' OR prompt LIKE '%space%' 
-                    OR prompt LIKE '%лес%' OR prompt LIKE '%forest%'
-                    OR prompt LIKE '%море%' OR prompt LIKE '%sea%'
-                    OR prompt LIKE '%город%' OR prompt LIKE '%city%'
-                    OR prompt LIKE '%офис%' OR prompt LIKE '%office%'
-                    OR prompt LIKE '%парк%' OR prompt LIKE '%park%'
-                    THEN 1 
-                END) as with_location,
-                AVG(CASE 
-                    WHEN prompt LIKE '%космос%' OR prompt LIKE '%space%' 
-                    OR prompt LIKE '%лес%' OR prompt LIKE '%forest%'
-                    OR prompt LIKE '%море%' OR prompt LIKE '%sea%'
-                    OR prompt LIKE '%город%' OR prompt LIKE '%city%'
-                    OR prompt LIKE '%офис%' OR prompt LIKE '%office%'
-                    OR prompt LIKE '%парк%' OR prompt LIKE '%park%'
-                    THEN rating 
-                END) as location_avg_rating
+                SUM(is_location) as with_location,
+                AVG(CASE WHEN is_location = 1 THEN rating END) as location_avg_rating
             FROM stickers
-            WHERE is_deleted = 0
+            WHERE is_deleted = 0;
         """)
-        print("  ✅ Создано представление location_prompt_analysis")
+        say("  ✅ Созданы представления: generation_type_stats, "
+            "style_background_correlation, location_prompt_analysis")
+
+        # Обновляем статистику планировщика, чтобы новые индексы реально
+        # использовались, а не отбрасывались по эвристическим оценкам
+        await db.execute("ANALYZE")
+        await db.execute("PRAGMA optimize")
 
         await db.commit()
 
         # Показываем статистику
-        print("\n📊 Анализ существующих данных:")
+        say("\n📊 Анализ существующих данных:")
 
         # Анализ промптов
         cursor = await db.execute("""
@@ -135,9 +188,9 @@ async def migrate_smart_backgrounds():
 
         if total > 0:
             location_percent = (with_location / total * 100) if with_location else 0
-            print(f"\n  📝 Анализ промптов:")
-            print(f"  • Всего стикеров: {total}")
-            print(f"  • Возможно с локацией: {with_location} ({location_percent:.1f}%)")
+            say(f"\n  📝 Анализ промптов:")
+            say(f"  • Всего стикеров: {total}")
+            say(f"  • Возможно с локацией: {with_location} ({location_percent:.1f}%)")
 
         # Статистика по стилям
         cursor = await db.execute("""
@@ -151,20 +204,23 @@ async def migrate_smart_backgrounds():
 
         styles = await cursor.fetchall()
         if styles:
-            print(f"\n  🎨 Топ стилей:")
+            say(f"\n  🎨 Топ стилей:")
             for style, count, rating in styles:
                 rating_str = f"{rating:.1f}" if rating else "N/A"
-                print(f"  • {style}: {count} стикеров (рейтинг: {rating_str})")
+                say(f"  • {style}: {count} стикеров (рейтинг: {rating_str})")
 
-        print("\n✨ Миграция завершена!")
-        print("\n🚀 Новые возможности:")
-        print("  • AI автоматически определяет нужен ли фон")
-        print("  • 'кот' → минимальный фон")
-        print("  • 'кот в космосе' → космический фон")
-        print("  • Улучшенное качество генерации")
-        print("  • Автоматическое удаление простых фонов")
-        print("\n💡 Обновите код бота для использования новых функций!")
+        say("\n✨ Миграция завершена!")
+        say("\n🚀 Новые возможности:")
+        say("  • AI автоматически определяет нужен ли фон")
+        say("  • 'кот' → минимальный фон")
+        say("  • 'кот в космосе' → космический фон")
+        say("  • Улучшенное качество генерации")
+        say("  • Автоматическое удаление простых фонов")
+        say("\n💡 Обновите код бота для использования новых функций!")
 
 
 if __name__ == "__main__":
-    asyncio.run(migrate_smart_backgrounds())
\ No newline at end of file
+    try:
+        asyncio.run(migrate_smart_backgrounds())
+    finally:
+        flush_output()
\ No newline at end of file
@@ -3,9 +3,9 @@
 Скрипт миграции для перехода на fofr/sticker-maker
 Обновляет БД и настройки
 """
+import json
 import sqlite3
 from pathlib import Path
-import json
 from datetime import datetime
 
 # Путь к БД
@@ -20,10 +20,28 @@ def migrate_to_sticker_maker():
         print("❌ База данных не найдена!")
         return
 
-    conn = sqlite3.connect(DB_PATH)
+    # Транзакцией управляем явно: вся миграция — один BEGIN IMMEDIATE/commit
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
     cursor = conn.cursor()
 
     try:
+        # Настройки для пакетной миграции: одноразовый offline-прогон,
+        # durability можно ослабить до предела — перед запуском уже снят
+        # бэкап, поэтому synchronous=OFF безопасен. Кэш и временные
+        # структуры в памяти, mmap для чтения, эксклюзивная блокировка
+        # избавляет от повторного захвата локов на каждую транзакцию.
+        # Все параметры, кроме journal_mode, действуют только на это
+        # соединение и «откатываются» сами при закрытии
+        cursor.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=OFF;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-512000;
+            PRAGMA mmap_size=268435456;
+            PRAGMA locking_mode=EXCLUSIVE;
+        """)
+        cursor.execute("BEGIN IMMEDIATE")
+
         # 1. Обновляем значения background на 'auto'
         print("\n1️⃣ Обновляю поле background...")
         cursor.execute("""
@@ -34,67 +52,115 @@ def migrate_to_sticker_maker():
         updated = cursor.rowcount
         print(f"   ✅ Обновлено записей: {updated}")
 
-        # 2. Добавляем индекс если его нет
-        print("\n2️⃣ Проверяю индексы...")
+        # 2. Добавляем генерируемые колонки и индекс
+        print("\n2️⃣ Проверяю колонки и индексы...")
+        # VIRTUAL-колонки поверх JSON: извлечение модели и времени генерации
+        # описано один раз в схеме, хранения не требует, а индекс по
+        # model_ext позволяет планировщику группировать без разбора JSON.
+        # json_extract падает на битом JSON, поэтому выражения защищены
+        # json_valid — кривая строка дает NULL, а не ломает построение
+        # индекса и все запросы к колонкам
+        for ddl in (
+            """ALTER TABLE stickers ADD COLUMN model_ext TEXT
+               GENERATED ALWAYS AS (
+                   COALESCE(
+                       CASE WHEN json_valid(metadata)
+                            THEN json_extract(metadata, '$.model')
+                       END,
+                       'sdxl'
+                   )
+               ) VIRTUAL""",
+            """ALTER TABLE stickers ADD COLUMN gen_time_ext REAL
+               GENERATED ALWAYS AS (
+                   CASE WHEN json_valid(metadata)
+                        THEN CAST(json_extract(metadata, '$.generation_time') AS REAL)
+                   END
+               ) VIRTUAL""",
+        ):
+            try:
+                cursor.execute(ddl)
+            except sqlite3.OperationalError as e:
+                if "duplicate column" not in str(e):
+                    raise
+
+        cursor.execute("DROP INDEX IF EXISTS idx_stickers_model")
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_stickers_model 
-            ON stickers(metadata)
+            CREATE INDEX IF NOT EXISTS idx_stickers_model_ext
+            ON stickers(model_ext)
+            WHERE is_deleted = FALSE
         """)
-        print("   ✅ Индексы обновлены")
+        print("   ✅ Колонки и индексы обновлены")
 
         # 3. Обновляем метаданные для указания модели
         print("\n3️⃣ Обновляю метаданные...")
-        cursor.execute("SELECT id, metadata FROM stickers WHERE metadata IS NOT NULL")
-        stickers = cursor.fetchall()
+        # json_set дописывает ключ прямо в SQLite: строки не гоняются через
+        # Python и не декодируются/кодируются заново. Обновляем порциями
+        # по 5000 строк с коммитом между ними: это только ограничивает
+        # рост WAL на большой таблице — прогон офлайновый, и
+        # locking_mode=EXCLUSIVE выше всё равно не пускает читателей
+        total_meta = 0
+        while True:
+            cursor.execute("""
+                UPDATE stickers
+                SET metadata = json_set(metadata, '$.model', 'sdxl')
+                WHERE id IN (
+                    SELECT id FROM stickers
+                    WHERE metadata IS NOT NULL
+                      AND json_valid(metadata)
+                      AND json_extract(metadata, '$.model') IS NULL
+                    LIMIT 5000
+                )
+            """)
+            if cursor.rowcount == 0:
+                break
+            total_meta += cursor.rowcount
+            conn.commit()
+            cursor.execute("BEGIN IMMEDIATE")
 
-        updated_meta = 0
-        for sticker_id, metadata_str in stickers:
-            try:
-                metadata = json.loads(metadata_str) if metadata_str else {}
-                if 'model' not in metadata:
-                    metadata['model'] = 'sdxl'  # Старые стикеры были на SDXL
-                    cursor.execute(
-                        "UPDATE stickers SET metadata = ? WHERE id = ?",
-                        (json.dumps(metadata), sticker_id)
-                    )
-                    updated_meta += 1
-            except:
-                pass
-
-        print(f"   ✅ Обновлено метаданных: {updated_meta}")
+        print(f"   ✅ Обновлено метаданных: {total_meta}")
 
         # 4. Создаем представление для аналитики по моделям
         print("\n4️⃣ Создаю представления для аналитики...")
         cursor.execute("DROP VIEW IF EXISTS model_statistics")
+        # Агрегация и сериализация на стороне SQLite: представление отдает
+        # одну JSON-строку вместо курсора с построчной выборкой
         cursor.execute("""
             CREATE VIEW model_statistics AS
-            SELECT 
-                COALESCE(
-                    json_extract(metadata, '$.model'), 
-                    'sdxl'
-                ) as model,
-                COUNT(*) as total_stickers,
-                AVG(rating) as avg_rating,
-                AVG(json_extract(metadata, '$.generation_time')) as avg_generation_time
-            FROM stickers
-            WHERE is_deleted = FALSE
-            GROUP BY model
+            SELECT json_group_object(
+                model,
+                json_object(
+                    'count', total_stickers,
+                    'avg_rating', avg_rating,
+                    'avg_gen', avg_generation_time
+                )
+            ) AS stats
+            FROM (
+                SELECT
+                    model_ext as model,
+                    COUNT(*) as total_stickers,
+                    AVG(rating) as avg_rating,
+                    AVG(gen_time_ext) as avg_generation_time
+                FROM stickers
+                WHERE is_deleted = FALSE
+                GROUP BY model_ext
+            )
         """)
         print("   ✅ Представления созданы")
 
         # 5. Добавляем настройку модели в user_preferences
         print("\n5️⃣ Обновляю настройки пользователей...")
 
-        # Проверяем существование колонки
-        cursor.execute("PRAGMA table_info(user_preferences)")
-        columns = [col[1] for col in cursor.fetchall()]
-
-        if 'preferred_model' not in columns:
+        # Пробуем добавить колонку сразу: один запрос вместо
+        # PRAGMA table_info + fetchall + поиск по списку
+        try:
             cursor.execute("""
-                ALTER TABLE user_preferences 
+                ALTER TABLE user_preferences
                 ADD COLUMN preferred_model TEXT DEFAULT 'sticker-maker'
             """)
             print("   ✅ Добавлено поле preferred_model")
+        except sqlite3.OperationalError as e:
+            if "duplicate column" not in str(e):
+                raise
 
         # Коммитим изменения
         conn.commit()
@@ -109,11 +175,15 @@ def migrate_to_sticker_maker():
         total_users = cursor.fetchone()[0]
         print(f"   Активных пользователей: {total_users}")
 
-        cursor.execute("SELECT * FROM model_statistics")
+        # Одна строка из представления, один json.loads
+        stats_json = cursor.execute("SELECT stats FROM model_statistics").fetchone()[0]
         print("\n   Статистика по моделям:")
-        for row in cursor.fetchall():
-            model, count, rating, gen_time = row
-            print(f"   - {model}: {count} стикеров, рейтинг {rating or 0:.2f}, время {gen_time or 0:.1f}с")
+        for model, stat in json.loads(stats_json or "{}").items():
+            print(f"   - {model}: {stat['count']} стикеров, "
+                  f"рейтинг {stat['avg_rating'] or 0:.2f}, время {stat['avg_gen'] or 0:.1f}с")
+
+        # Сбрасываем разросшийся за миграцию WAL обратно в основной файл
+        cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
 
         print("\n✅ Миграция успешно завершена!")
         print("\n🎯 Рекомендации:")
@@ -135,8 +205,17 @@ def create_backup():
         backup_name = f"bot_database_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
         backup_path = DB_PATH.parent / backup_name
 
-        import shutil
-        shutil.copy2(DB_PATH, backup_path)
+        # Online backup API вместо копирования файла: консистентный снимок
+        # даже при включенном WAL и открытых читателях
+        src = sqlite3.connect(DB_PATH)
+        dst = sqlite3.connect(backup_path)
+        try:
+            with dst:
+                src.backup(dst, pages=1024, sleep=0)
+        finally:
+            dst.close()
+            src.close()
+
         print(f"📦 Создана резервная копия: {backup_path}")
         return True
     return False
@@ -1,29 +1,74 @@
 # prompt_optimization/optimizer.py
 
+import atexit
 import json
+import os
+import pickle
 import random
+import sqlite3
+import threading
+import time
 from typing import Dict, List, Optional, Tuple
-from datetime import datetime, timedelta
 import asyncio
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, field, fields
 import numpy as np
 from pathlib import Path
 
 from logger import logger
 
+# orjson (Rust, SIMD) в разы быстрее stdlib json на encode и decode;
+# зависимость опциональная — без нее работаем через stdlib
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+def _json_load(f):
+    """Читает JSON из открытого бинарного/текстового файла"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(f.read())
+    return json.load(f)
+
+
+def _json_dump(data, path):
+    """Пишет JSON с отступами в файл по пути path"""
+    if ORJSON_AVAILABLE:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+
 
-@dataclass
+# slots=True: атрибуты читаются напрямую из слотов (без __dict__),
+# а каждый экземпляр занимает примерно вдвое меньше памяти
+@dataclass(slots=True)
 class PromptTemplate:
     """Шаблон промпта для тестирования"""
     id: str
     name: str
     system_prompt: str
     example_format: str
-    success_rate: float = 0.0
     total_uses: int = 0
+    total_successes: int = 0
     total_rating: int = 0
     active: bool = True
 
+    # UTF-8-представление неизменяемых строк кодируется один раз здесь,
+    # а не при каждой отправке шаблона во внешний API
+    system_prompt_bytes: bytes = field(init=False, repr=False)
+    example_format_bytes: bytes = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.system_prompt_bytes = self.system_prompt.encode('utf-8')
+        self.example_format_bytes = self.example_format.encode('utf-8')
+
+    @property
+    def success_rate(self) -> float:
+        return self.total_successes / self.total_uses if self.total_uses > 0 else 0.0
+
     @property
     def average_rating(self) -> float:
         return self.total_rating / self.total_uses if self.total_uses > 0 else 0.0
@@ -32,12 +77,82 @@ class PromptTemplate:
 class PromptOptimizer:
     """Система оптимизации промптов с A/B тестированием"""
 
-    def __init__(self, config_path: str = "prompt_templates.json"):
+    # Минимальный интервал между записями prompt_templates.json, секунд
+    SAVE_INTERVAL = 5.0
+
+    # Сколько результатов тестов копить перед записью в SQLite
+    RESULTS_FLUSH_EVERY = 20
+
+    def __init__(self, config_path: str = "prompt_templates.json",
+                 results_db_path: str = "prompt_test_results.db"):
         self.config_path = config_path
+
+        # Отложенная запись: рейтинги лишь помечают шаблоны как dirty,
+        # на диск пишем не чаще SAVE_INTERVAL и при завершении процесса
+        self._dirty = False
+        self._last_save = 0.0
+        atexit.register(self._flush_templates)
+
+        # Результаты тестов храним в append-only таблице SQLite: список
+        # в памяти рос неограниченно, а 7-дневная сводка парсила каждый
+        # ISO-timestamp заново при любом запросе статистики
+        self._results_conn = sqlite3.connect(results_db_path, check_same_thread=False)
+        self._results_conn.executescript("""
+            CREATE TABLE IF NOT EXISTS prompt_test_results(
+                ts REAL NOT NULL,
+                template_id TEXT NOT NULL,
+                rating INTEGER NOT NULL,
+                is_success INTEGER NOT NULL,
+                request TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_ptr_ts ON prompt_test_results(ts);
+        """)
+        self._pending_results = []
+        atexit.register(self._flush_results)
+
+        # deactivate_poor_performers уходит в worker-поток и тоже пишет
+        # шаблоны; без блокировки два сохранения делят один .tmp-файл и
+        # могут опубликовать битый JSON/pickle
+        self._save_lock = threading.Lock()
+
         self.templates = self._load_templates()
-        self.test_results = []
         self.current_champion = None
 
+        # Кэш для векторизованного Thompson Sampling: массивы Beta-параметров
+        # пересобираются при изменении шаблонов, а не на каждый запрос
+        self._rng = np.random.default_rng()
+        self._active_ids = []
+        self._all_cold = True
+        self._alpha = np.empty(0)
+        self._beta = np.empty(0)
+        self._sampling_cache_valid = False
+
+    def _rebuild_sampling_cache(self):
+        """Пересобирает массивы Beta-параметров активных шаблонов"""
+        self._active_ids = [tid for tid, t in self.templates.items() if t.active]
+        # "Холодный" режим: статистики нет ни у кого, Beta-сэмплирование
+        # выродилось бы в равномерный выбор — заменяем его random.choice
+        self._all_cold = all(
+            self.templates[tid].total_uses == 0 for tid in self._active_ids
+        )
+        alpha = []
+        beta = []
+        for tid in self._active_ids:
+            template = self.templates[tid]
+            if template.total_uses == 0:
+                # Начальный оптимистичный score для исследования
+                alpha.append(1.0)
+                beta.append(1.0)
+            else:
+                # Байесовский подход: Beta(успехи + 1, неудачи + 1)
+                successes = template.total_successes
+                failures = template.total_uses - successes
+                alpha.append(max(1, successes + 1))
+                beta.append(max(1, failures + 1))
+        self._alpha = np.array(alpha)
+        self._beta = np.array(beta)
+        self._sampling_cache_valid = True
+
     def _load_templates(self) -> Dict[str, PromptTemplate]:
         """Загрузка шаблонов промптов"""
         default_templates = {
@@ -118,11 +233,29 @@ PRIORITY ORDER:
         # Пытаемся загрузить сохраненные шаблоны
         config_file = Path(self.config_path)
         if config_file.exists():
+            # Сначала пробуем pickle-кэш: на холодном старте это быстрее,
+            # чем разбор JSON и пересборка dataclass'ов по одному kwarg-вызову.
+            # Кэш валиден, только если он не старше самого JSON-файла
+            cache_file = config_file.with_suffix(".pkl")
             try:
-                with open(config_file, 'r', encoding='utf-8') as f:
-                    saved_data = json.load(f)
+                if (cache_file.exists()
+                        and cache_file.stat().st_mtime >= config_file.stat().st_mtime):
+                    with open(cache_file, 'rb') as f:
+                        cached = pickle.load(f)
+                    return {tid: PromptTemplate(**tdata) for tid, tdata in cached}
+            except Exception as e:
+                logger.warning(f"Кэш шаблонов не прочитан, падаю на JSON: {e}")
+
+            try:
+                with open(config_file, 'rb') as f:
+                    saved_data = _json_load(f)
                     templates = {}
                     for tid, tdata in saved_data.items():
+                        # Совместимость со старым форматом: success_rate теперь
+                        # вычисляется из целочисленного total_successes
+                        rate = tdata.pop("success_rate", None)
+                        if "total_successes" not in tdata and rate is not None:
+                            tdata["total_successes"] = round(rate * tdata.get("total_uses", 0))
                         templates[tid] = PromptTemplate(**tdata)
                     return templates
             except Exception as e:
@@ -134,43 +267,71 @@ PRIORITY ORDER:
         return default_templates
 
     def _save_templates(self, templates: Dict[str, PromptTemplate]):
-        """Сохранение шаблонов"""
-        data = {tid: asdict(t) for tid, t in templates.items()}
-        with open(self.config_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        """Сохранение шаблонов (атомарно, через временный файл)"""
+        # Под блокировкой: сохранение зовется и с event loop
+        # (record_result), и из worker-потока (deactivate_poor_performers),
+        # а оба пишут в одни и те же .tmp-файлы
+        with self._save_lock:
+            # Сериализуем только init-поля: производные byte-блобы
+            # пересчитываются в __post_init__ при загрузке
+            data = {
+                tid: {f.name: getattr(t, f.name) for f in fields(t) if f.init}
+                for tid, t in templates.items()
+            }
+            tmp_path = f"{self.config_path}.tmp"
+            _json_dump(data, tmp_path)
+            os.replace(tmp_path, self.config_path)
+
+            # Pickle-кэш рядом с JSON: следующий запуск процесса минует
+            # токенизацию JSON (JSON остается каноническим человекочитаемым форматом)
+            cache_path = Path(self.config_path).with_suffix(".pkl")
+            cache_tmp = f"{cache_path}.tmp"
+            with open(cache_tmp, 'wb') as f:
+                pickle.dump(list(data.items()), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_tmp, cache_path)
+
+            self._dirty = False
+            self._last_save = time.monotonic()
+
+    def _flush_templates(self):
+        """Сбрасывает несохраненные изменения шаблонов на диск"""
+        if self._dirty:
+            self._save_templates(self.templates)
+
+    def _flush_results(self):
+        """Записывает накопленные результаты тестов одним executemany"""
+        # Атомарная подмена списка: deactivate_poor_performers выполняется
+        # в worker-потоке, и append из record_result на event loop между
+        # executemany и clear() иначе молча терялся бы
+        pending, self._pending_results = self._pending_results, []
+        if pending:
+            with self._results_conn:
+                self._results_conn.executemany(
+                    "INSERT INTO prompt_test_results VALUES (?, ?, ?, ?, ?)",
+                    pending
+                )
 
     def get_test_template(self, user_id: int) -> PromptTemplate:
         """Выбор шаблона для A/B тестирования"""
-        active_templates = [t for t in self.templates.values() if t.active]
+        if not self._sampling_cache_valid:
+            self._rebuild_sampling_cache()
 
-        if not active_templates:
+        if not self._active_ids:
             return list(self.templates.values())[0]
 
-        # Используем Thompson Sampling для выбора шаблона
-        scores = []
-        for template in active_templates:
-            # Для новых шаблонов используем оптимистичный подход
-            if template.total_uses == 0:
-                # Начальный оптимистичный score для исследования
-                score = np.random.beta(1, 1)  # Uniform distribution
-            else:
-                # Байесовский подход: Beta(успехи + 1, неудачи + 1)
-                successes = int(template.success_rate * template.total_uses)
-                failures = template.total_uses - successes
-
-                # Добавляем псевдо-наблюдения для стабильности
-                alpha = max(1, successes + 1)
-                beta_param = max(1, failures + 1)
-
-                score = np.random.beta(alpha, beta_param)
+        # Пока все шаблоны холодные, обходимся без Beta-математики
+        if self._all_cold:
+            selected_template = self.templates[random.choice(self._active_ids)]
+            logger.info(f"Выбран шаблон {selected_template.name} для пользователя {user_id} (cold start)")
+            return selected_template
 
-            scores.append((score, template))
+        # Thompson Sampling: один векторизованный вызов Beta-сэмплера
+        # вместо отдельного np.random.beta на каждый шаблон
+        scores = self._rng.beta(self._alpha, self._beta)
+        idx = int(scores.argmax())
+        selected_template = self.templates[self._active_ids[idx]]
 
-        # Выбираем шаблон с наивысшим сэмплированным score
-        scores.sort(key=lambda x: x[0], reverse=True)
-        selected_template = scores[0][1]
-
-        logger.info(f"Выбран шаблон {selected_template.name} для пользователя {user_id} (score: {scores[0][0]:.3f})")
+        logger.info(f"Выбран шаблон {selected_template.name} для пользователя {user_id} (score: {scores[idx]:.3f})")
         return selected_template
 
     def record_result(self, template_id: str, rating: int, request: str):
@@ -182,24 +343,27 @@ PRIORITY ORDER:
         template.total_uses += 1
         template.total_rating += rating
 
-        # Обновляем success rate (оценка 4-5 считается успехом)
+        # Оценка 4-5 считается успехом; целочисленный счетчик вместо
+        # пересчета float — без накопления ошибки округления
         is_success = rating >= 4
-        template.success_rate = (
-                (template.success_rate * (template.total_uses - 1) + (1 if is_success else 0))
-                / template.total_uses
+        if is_success:
+            template.total_successes += 1
+
+        # Сохраняем результат для анализа (пакетная запись в SQLite)
+        self._pending_results.append(
+            (time.time(), template_id, rating, int(is_success), request)
         )
+        if len(self._pending_results) >= self.RESULTS_FLUSH_EVERY:
+            self._flush_results()
 
-        # Сохраняем результат для анализа
-        self.test_results.append({
-            "timestamp": datetime.now().isoformat(),
-            "template_id": template_id,
-            "rating": rating,
-            "request": request,
-            "is_success": is_success
-        })
+        # Параметры Beta-распределения изменились — кэш сэмплера устарел
+        self._sampling_cache_valid = False
 
-        # Сохраняем обновлённые шаблоны
-        self._save_templates(self.templates)
+        # Сохраняем обновлённые шаблоны не чаще раза в SAVE_INTERVAL:
+        # полная перезапись JSON на каждую оценку — лишний файловый I/O
+        self._dirty = True
+        if time.monotonic() - self._last_save > self.SAVE_INTERVAL:
+            self._save_templates(self.templates)
 
         # Проверяем, нужно ли обновить чемпиона
         self._update_champion()
@@ -232,10 +396,16 @@ PRIORITY ORDER:
 
     def get_statistics(self) -> Dict:
         """Получение статистики по шаблонам"""
+        self._flush_results()
+
+        total_tests = self._results_conn.execute(
+            "SELECT COUNT(*) FROM prompt_test_results"
+        ).fetchone()[0]
+
         stats = {
             "templates": {},
             "current_champion": self.current_champion,
-            "total_tests": len(self.test_results)
+            "total_tests": total_tests
         }
 
         for tid, template in self.templates.items():
@@ -247,17 +417,18 @@ PRIORITY ORDER:
                 "active": template.active
             }
 
-        # Анализ последних 7 дней
-        recent_results = [
-            r for r in self.test_results
-            if datetime.fromisoformat(r["timestamp"]) > datetime.now() - timedelta(days=7)
-        ]
+        # Анализ последних 7 дней — диапазонный запрос по индексу ts
+        recent_count, recent_rating, recent_success = self._results_conn.execute(
+            "SELECT COUNT(*), AVG(rating), AVG(is_success) "
+            "FROM prompt_test_results WHERE ts > ?",
+            (time.time() - 7 * 86400,)
+        ).fetchone()
 
-        if recent_results:
+        if recent_count:
             stats["recent_7_days"] = {
-                "total_tests": len(recent_results),
-                "avg_rating": sum(r["rating"] for r in recent_results) / len(recent_results),
-                "success_rate": sum(1 for r in recent_results if r["is_success"]) / len(recent_results)
+                "total_tests": recent_count,
+                "avg_rating": recent_rating,
+                "success_rate": recent_success
             }
 
         return stats
@@ -265,38 +436,52 @@ PRIORITY ORDER:
     def add_custom_template(self, template: PromptTemplate):
         """Добавление пользовательского шаблона"""
         self.templates[template.id] = template
+        self._sampling_cache_valid = False
         self._save_templates(self.templates)
         logger.info(f"Добавлен новый шаблон: {template.name}")
 
     def deactivate_poor_performers(self, min_uses: int = 50, success_threshold: float = 0.3):
         """Деактивация плохо работающих шаблонов"""
+        self._flush_results()
+
+        # Один агрегатный запрос вместо обхода шаблонов в Python:
+        # группировка и фильтр считаются внутри SQLite
+        poor_ids = self._results_conn.execute(
+            "SELECT template_id FROM prompt_test_results "
+            "GROUP BY template_id "
+            "HAVING COUNT(*) >= ? AND AVG(is_success) < ?",
+            (min_uses, success_threshold)
+        ).fetchall()
+
         deactivated = []
-        for template in self.templates.values():
-            if template.total_uses >= min_uses and template.success_rate < success_threshold:
-                template.active = False
-                deactivated.append(template.name)
-                logger.info(f"Деактивирован шаблон {template.name} "
-                            f"(success rate: {template.success_rate:.1%})")
+        for (tid,) in poor_ids:
+            template = self.templates.get(tid)
+            if template is None or not template.active:
+                continue
+            template.active = False
+            deactivated.append(template.name)
+            logger.info(f"Деактивирован шаблон {template.name} "
+                        f"(success rate: {template.success_rate:.1%})")
 
         if deactivated:
+            self._sampling_cache_valid = False
             self._save_templates(self.templates)
 
         return deactivated
 
     def export_best_practices(self) -> List[Dict]:
         """Экспорт лучших практик на основе результатов"""
-        # Анализируем успешные генерации
-        successful_results = [r for r in self.test_results if r["is_success"]]
+        self._flush_results()
 
-        # Группируем по шаблонам
+        # Анализируем успешные генерации, сгруппированные по шаблонам
         template_examples = {}
-        for result in successful_results:
-            tid = result["template_id"]
-            if tid not in template_examples:
-                template_examples[tid] = []
-            template_examples[tid].append({
-                "request": result["request"],
-                "rating": result["rating"]
+        for tid, request, rating in self._results_conn.execute(
+            "SELECT template_id, request, rating FROM prompt_test_results "
+            "WHERE is_success = 1"
+        ):
+            template_examples.setdefault(tid, []).append({
+                "request": request,
+                "rating": rating
             })
 
         # Выбираем лучшие примеры для каждого шаблона
@@ -331,8 +516,9 @@ PRIORITY ORDER:
         """Периодическая оптимизация (запускать в фоне)"""
         while True:
             try:
-                # Деактивируем плохие шаблоны
-                deactivated = self.deactivate_poor_performers()
+                # Деактивируем плохие шаблоны (внутри — синхронная запись
+                # JSON на диск, уводим ее с потока event loop'а)
+                deactivated = await asyncio.to_thread(self.deactivate_poor_performers)
 
                 if deactivated:
                     logger.info(f"Деактивировано {len(deactivated)} плохих шаблонов")
@@ -340,9 +526,9 @@ PRIORITY ORDER:
                 # Экспортируем лучшие практики
                 best_practices = self.export_best_practices()
 
-                # Сохраняем в файл
-                with open('best_practices.json', 'w', encoding='utf-8') as f:
-                    json.dump(best_practices, f, indent=2, ensure_ascii=False)
+                # Сохраняем в файл в worker-потоке: event loop не стоит
+                # на JSON-кодировании и файловом I/O раз в сутки
+                await asyncio.to_thread(_json_dump, best_practices, 'best_practices.json')
 
                 logger.info(f"Экспортировано {len(best_practices)} лучших практик")
 
@@ -3,15 +3,199 @@
 Упрощенная версия для работы с fofr/sticker-maker
 Добавлена поддержка текста на стикерах
 """
+import asyncio
 import io
 import os
+import platform
+import shutil
+import subprocess
+from functools import lru_cache
 from typing import Union, Optional, Tuple
+import PIL
 from PIL import Image, ImageEnhance, ImageDraw, ImageFont, ImageFilter
 from pathlib import Path
 
 # Assuming 'logger' and 'log_function' are defined in a 'logger' module
 from logger import logger, log_function
 
+# Pillow-SIMD — drop-in замена Pillow (API PIL.Image идентичен), её версии
+# имеют суффикс .postN. Логируем активный бэкенд, чтобы регрессия после
+# переустановки окружения была видна в логах
+if "post" in getattr(PIL, "__version__", ""):
+    logger.info(f"Imaging backend: Pillow-SIMD {PIL.__version__}")
+else:
+    logger.info(f"Imaging backend: Pillow {PIL.__version__} (pillow-simd не установлен)")
+
+# Кандидаты на красивый шрифт — только для текущей платформы,
+# чтобы не стат'ить заведомо чужие пути
+_FONT_CANDIDATES = {
+    "Darwin": (
+        "/System/Library/Fonts/Helvetica.ttc",
+        "/Library/Fonts/Arial Unicode.ttf",
+        "/System/Library/Fonts/Avenir.ttc",
+    ),
+    "Linux": (
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+        "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
+    ),
+    "Windows": (
+        "C:/Windows/Fonts/Arial.ttf",
+        "C:/Windows/Fonts/impact.ttf",
+    ),
+}
+
+# Реально существующие шрифты платформы, вычисленные один раз при импорте
+_AVAILABLE_FONTS = tuple(
+    p for p in _FONT_CANDIDATES.get(platform.system(), ()) if os.path.exists(p)
+)
+
+# Путь ищем один раз при импорте, а не os.path.exists × 7 на каждый стикер
+_FONT_PATH = _AVAILABLE_FONTS[0] if _AVAILABLE_FONTS else None
+
+
+# pngquant (libimagequant) жмёт палитровый PNG с альфой лучше и быстрее
+# медиан-ката PIL; используем бинарь, если он есть в системе
+_PNGQUANT = shutil.which("pngquant")
+
+# oxipng дожимает PNG без потерь заметно быстрее, чем zlib level 9
+_OXIPNG = shutil.which("oxipng")
+
+
+def _optimize_png(png_bytes: bytes) -> bytes:
+    """Дожимает PNG без потерь через oxipng; при неудаче — исходные байты"""
+    if not _OXIPNG:
+        return png_bytes
+    try:
+        proc = subprocess.run(
+            [_OXIPNG, "-o", "2", "--strip", "safe", "--stdout", "-"],
+            input=png_bytes, stdout=subprocess.PIPE, check=True,
+        )
+        if proc.stdout and len(proc.stdout) < len(png_bytes):
+            return proc.stdout
+    except Exception as e:
+        logger.warning(f"oxipng failed: {e}")
+    return png_bytes
+
+
+def _quantize_png(png_bytes: bytes) -> bytes:
+    """Квантует PNG через pngquant; при неудаче возвращает исходные байты"""
+    if not _PNGQUANT:
+        return png_bytes
+    try:
+        proc = subprocess.run(
+            [_PNGQUANT, "--speed", "3", "--quality", "60-90", "-"],
+            input=png_bytes, stdout=subprocess.PIPE, check=True,
+        )
+        if proc.stdout and len(proc.stdout) < len(png_bytes):
+            return proc.stdout
+    except Exception as e:
+        logger.warning(f"pngquant failed: {e}")
+    return png_bytes
+
+
+_PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+
+
+def _png_header_info(data: bytes) -> Optional[Tuple[int, int, int]]:
+    """Читает (width, height, color_type) из IHDR, не декодируя PNG"""
+    if len(data) < 26 or not data.startswith(_PNG_MAGIC) or data[12:16] != b"IHDR":
+        return None
+    width = int.from_bytes(data[16:20], "big")
+    height = int.from_bytes(data[20:24], "big")
+    color_type = data[25]
+    return width, height, color_type
+
+
+@lru_cache(maxsize=32)
+def _load_font(size: int):
+    """Возвращает шрифт нужного размера (FreeType-парсинг — один раз на размер)"""
+    if _FONT_PATH:
+        try:
+            return ImageFont.truetype(_FONT_PATH, size)
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить шрифт {_FONT_PATH}: {e}")
+    return ImageFont.load_default()
+
+
+def _add_text_image(
+        img: Image.Image,
+        text: str,
+        position: str = "bottom",
+        font_scale: float = 1.0
+) -> Image.Image:
+    """
+    Наносит текст на PIL-изображение и возвращает PIL-изображение.
+
+    Внутренний шаг конвейера: работает с объектом напрямую, без
+    промежуточного PNG-кодирования (см. add_text_to_sticker для байтов)
+    """
+    # Конвертируем в RGBA если нужно
+    if img.mode != 'RGBA':
+        img = img.convert('RGBA')
+
+    # Создаем слой для текста
+    txt_layer = Image.new('RGBA', img.size, (255, 255, 255, 0))
+    draw = ImageDraw.Draw(txt_layer)
+
+    # Размер изображения
+    width, height = img.size
+
+    # Выбираем размер шрифта
+    base_font_size = int(height * 0.1 * font_scale)
+    if len(text) > 10:
+        base_font_size = int(base_font_size * 0.8)  # Уменьшаем для длинного текста
+
+    # Шрифт берем из кэша: путь найден при импорте, FreeType-объект
+    # мемоизирован по размеру
+    font = _load_font(base_font_size)
+
+    # Получаем размер текста
+    text_upper = text.upper()
+    bbox = draw.textbbox((0, 0), text_upper, font=font)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
+
+    # Добавляем отступы
+    padding = int(height * 0.02)
+
+    # Определяем позицию
+    x = (width - text_width) // 2
+
+    if position == "top":
+        y = padding
+    elif position == "center":
+        y = (height - text_height) // 2
+    else:  # bottom
+        y = height - text_height - padding
+
+    # Создаем эффект обводки
+    outline_width = max(3, base_font_size // 12)
+
+    # Рисуем тень для объема: один оттиск текста в L-маску, размытый
+    # тройным BoxBlur (приближение гауссова, но на скользящих суммах —
+    # стоимость не зависит от радиуса). Размывается только альфа:
+    # RGB тени — константный черный, кроме него информации в тени нет
+    shadow_offset = max(2, base_font_size // 20)
+    shadow_mask = Image.new('L', img.size, 0)
+    ImageDraw.Draw(shadow_mask).text(
+        (x + shadow_offset, y + shadow_offset), text_upper, font=font, fill=255
+    )
+    for _ in range(3):
+        shadow_mask = shadow_mask.filter(ImageFilter.BoxBlur(max(1, shadow_offset // 2)))
+    # Ограничиваем плотность тени прежним максимумом (80/255)
+    shadow_mask = shadow_mask.point(lambda v: v * 80 // 255)
+    txt_layer.paste((0, 0, 0, 255), (0, 0), shadow_mask)
+
+    # Рисуем текст с обводкой одним вызовом: FreeType сам строит
+    # контур (stroke_width/stroke_fill) — одна растеризация глифов
+    # вместо дилатации отдельной маски
+    draw.text((x, y), text_upper, font=font, fill=(20, 20, 20, 255),
+              stroke_width=outline_width, stroke_fill=(255, 255, 255, 255))
+
+    # Объединяем слои
+    logger.info(f"Text '{text[:10]}...' added to sticker at position: {position}")
+    return Image.alpha_composite(img, txt_layer)
+
 
 @log_function
 async def add_text_to_sticker(
@@ -39,102 +223,12 @@ async def add_text_to_sticker(
         else:
             img = image_data.copy()
 
-        # Конвертируем в RGBA если нужно
-        if img.mode != 'RGBA':
-            img = img.convert('RGBA')
-
-        # Создаем слой для текста
-        txt_layer = Image.new('RGBA', img.size, (255, 255, 255, 0))
-        draw = ImageDraw.Draw(txt_layer)
-
-        # Размер изображения
-        width, height = img.size
-
-        # Выбираем размер шрифта
-        base_font_size = int(height * 0.1 * font_scale)
-        if len(text) > 10:
-            base_font_size = int(base_font_size * 0.8)  # Уменьшаем для длинного текста
-
-        # Пытаемся загрузить красивый шрифт
-        font = None
-        font_paths = [
-            # macOS
-            "/System/Library/Fonts/Helvetica.ttc",
-            "/Library/Fonts/Arial Unicode.ttf",
-            "/System/Library/Fonts/Avenir.ttc",
-            # Linux
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
-            "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
-            # Windows
-            "C:/Windows/Fonts/Arial.ttf",
-            "C:/Windows/Fonts/impact.ttf",
-        ]
-
-        for font_path in font_paths:
-            if os.path.exists(font_path):
-                try:
-                    font = ImageFont.truetype(font_path, base_font_size)
-                    break
-                except:
-                    continue
-
-        # Если не нашли шрифт, используем встроенный
-        if not font:
-            try:
-                # Пробуем загрузить встроенный шрифт побольше
-                font = ImageFont.load_default()
-                # Для встроенного шрифта увеличиваем размер текста визуально
-                text = text.upper()
-            except:
-                font = ImageFont.load_default()
-
-        # Получаем размер текста
-        text_upper = text.upper()
-        bbox = draw.textbbox((0, 0), text_upper, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-
-        # Добавляем отступы
-        padding = int(height * 0.02)
-
-        # Определяем позицию
-        x = (width - text_width) // 2
-
-        if position == "top":
-            y = padding
-        elif position == "center":
-            y = (height - text_height) // 2
-        else:  # bottom
-            y = height - text_height - padding
-
-        # Создаем эффект обводки
-        outline_width = max(3, base_font_size // 12)
-
-        # Рисуем тень для объема
-        shadow_offset = max(2, base_font_size // 20)
-        for offset in range(shadow_offset, 0, -1):
-            alpha = int(80 * (1 - offset / shadow_offset))
-            draw.text((x + offset, y + offset), text_upper,
-                      font=font, fill=(0, 0, 0, alpha))
-
-        # Рисуем белую обводку
-        for adj_x in range(-outline_width, outline_width + 1):
-            for adj_y in range(-outline_width, outline_width + 1):
-                if adj_x != 0 or adj_y != 0:
-                    draw.text((x + adj_x, y + adj_y), text_upper,
-                              font=font, fill=(255, 255, 255, 255))
-
-        # Рисуем основной текст
-        draw.text((x, y), text_upper, font=font, fill=(20, 20, 20, 255))
-
-        # Объединяем слои
-        img = Image.alpha_composite(img, txt_layer)
+        img = _add_text_image(img, text, position, font_scale)
 
         # Сохраняем результат
         output = io.BytesIO()
         img.save(output, format='PNG', optimize=True)
         output.seek(0)
-        logger.info(f"Text '{text[:10]}...' added to sticker at position: {position}")
         return output.read()
 
     except Exception as e:
@@ -149,68 +243,68 @@ async def add_text_to_sticker(
             return output.read()
 
 
-async def prepare_sticker_for_telegram(image_bytes: bytes) -> bytes:
-    """
-    Подготавливает стикер строго по требованиям Telegram
-
-    Требования Telegram:
-    - PNG формат
-    - 512x512 пикселей
-    - Прозрачный фон (альфа-канал)
-    - Размер файла < 512KB
-    """
-    try:
-        img = Image.open(io.BytesIO(image_bytes))
-
-        # 1. Конвертируем в RGBA для поддержки прозрачности
-        if img.mode != 'RGBA':
-            # Создаем альфа-канал
-            img = img.convert('RGBA')
-
-        # 2. Проверяем размер
-        if img.size != (512, 512):
-            img = img.resize((512, 512), Image.Resampling.LANCZOS)
-
-        # 3. Убеждаемся что есть прозрачные пиксели (Telegram требует)
-        # Проверяем альфа-канал
-        has_transparency = False
-        if img.mode == 'RGBA':
-            alpha = img.split()[-1]
-            if alpha.getextrema()[0] < 255:
-                has_transparency = True
-
-        # Если нет прозрачности, добавляем минимальную
-        if not has_transparency:
-            pixels = img.load()
-            # Делаем угловой пиксель полупрозрачным
-            if img.mode == 'RGBA':
-                pixels[0, 0] = (pixels[0, 0][0], pixels[0, 0][1], pixels[0, 0][2], 254)
-
-        # 4. Оптимизируем размер файла
-        output = io.BytesIO()
-
-        # Сохраняем с оптимизацией
-        img.save(output, 'PNG', optimize=True, compress_level=9)
-        output.seek(0)
-        result = output.read()
-
-        # Если файл слишком большой, уменьшаем качество
-        if len(result) > 500 * 1024:  # 500KB для безопасности
-            # Уменьшаем цвета
-            img = img.convert('P', palette=Image.ADAPTIVE, colors=128)
-            img = img.convert('RGBA')
-
-            output = io.BytesIO()
-            img.save(output, 'PNG', optimize=True, compress_level=9)
-            output.seek(0)
-            result = output.read()
-
-        logger.info(f"Prepared sticker for Telegram: {len(result)} bytes, has_transparency: {has_transparency}")
-        return result
-
-    except Exception as e:
-        logger.error(f"Error preparing sticker for Telegram: {e}")
-        return image_bytes
+def _process_sticker_sync(
+        image_data: Union[bytes, Image.Image],
+        target_size: Tuple[int, int],
+        enhance_quality: bool,
+        add_text: Optional[str],
+        text_position: str
+) -> Image.Image:
+    """Синхронная CPU-часть process_sticker (выполняется в worker-потоке)"""
+    # Открываем изображение
+    if isinstance(image_data, bytes):
+        image = Image.open(io.BytesIO(image_data))
+    else:
+        image = image_data
+
+    # Конвертируем в RGBA для поддержки прозрачности
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+
+    # Изменяем размер если нужно
+    if image.size != target_size:
+        # Считаем масштаб сами и делаем один resize вместо thumbnail:
+        # thumbnail мутирует переданное изображение на месте и строит
+        # лишний промежуточный буфер
+        scale = min(target_size[0] / image.width, target_size[1] / image.height)
+        new_w = max(1, int(image.width * scale))
+        new_h = max(1, int(image.height * scale))
+        resized = image.resize((new_w, new_h), Image.Resampling.LANCZOS)
+
+        # Центрируем на прозрачном холсте целевого размера
+        new_image = Image.new('RGBA', target_size, (0, 0, 0, 0))
+        new_image.paste(resized, ((target_size[0] - new_w) // 2,
+                                  (target_size[1] - new_h) // 2), resized)
+        image = new_image
+
+    # Улучшаем качество если нужно
+    if enhance_quality:
+        # Повышаем контраст
+        enhancer = ImageEnhance.Contrast(image)
+        image = enhancer.enhance(1.1)
+
+        # Повышаем резкость
+        enhancer = ImageEnhance.Sharpness(image)
+        image = enhancer.enhance(1.2)
+
+        # Повышаем насыщенность цветов
+        enhancer = ImageEnhance.Color(image)
+        image = enhancer.enhance(1.1)
+
+    # Добавляем текст если нужно — объектом, без промежуточного
+    # PNG-кодирования между шагами конвейера
+    if add_text and add_text.strip():
+        # Определяем размер шрифта в зависимости от позиции
+        font_scale = 1.0
+        if text_position == "center":
+            font_scale = 1.2  # Больше для центра
+
+        try:
+            image = _add_text_image(image, add_text.strip(), text_position, font_scale)
+        except Exception as e:
+            logger.error(f"Error adding text to sticker: {e}")
+
+    return image
 
 
 @log_function
@@ -235,70 +329,20 @@ async def process_sticker(
         bytes: Обработанное изображение в формате PNG
     """
     try:
-        # Открываем изображение
-        if isinstance(image_data, bytes):
-            image = Image.open(io.BytesIO(image_data))
-        else:
-            image = image_data
-
-        # Конвертируем в RGBA для поддержки прозрачности
-        if image.mode != 'RGBA':
-            image = image.convert('RGBA')
-
-        # Изменяем размер если нужно
-        if image.size != target_size:
-            # Сохраняем соотношение сторон
-            image.thumbnail(target_size, Image.Resampling.LANCZOS)
-
-            # Создаем новое изображение с целевым размером
-            new_image = Image.new('RGBA', target_size, (0, 0, 0, 0))
-
-            # Центрируем изображение
-            x = (target_size[0] - image.width) // 2
-            y = (target_size[1] - image.height) // 2
-            new_image.paste(image, (x, y), image)
-            image = new_image
-
-        # Улучшаем качество если нужно
-        if enhance_quality:
-            # Повышаем контраст
-            enhancer = ImageEnhance.Contrast(image)
-            image = enhancer.enhance(1.1)
-
-            # Повышаем резкость
-            enhancer = ImageEnhance.Sharpness(image)
-            image = enhancer.enhance(1.2)
-
-            # Повышаем насыщенность цветов
-            enhancer = ImageEnhance.Color(image)
-            image = enhancer.enhance(1.1)
-
-        # Сохраняем в bytes
-        output = io.BytesIO()
-        image.save(output, format='PNG', optimize=True)
-        output.seek(0)
-        result_bytes = output.read()
-
-        # Добавляем текст если нужно
-        if add_text and add_text.strip():
-            # Определяем размер шрифта в зависимости от позиции
-            font_scale = 1.0
-            if text_position == "center":
-                font_scale = 1.2  # Больше для центра
-
-            result_bytes = await add_text_to_sticker(
-                result_bytes,
-                add_text.strip(),
-                text_position,
-                font_scale
-            )
+        # Вся CPU-часть конвейера (decode, resize, enhance, текст) — в
+        # worker-потоке: PIL держит GIL недолго, но стикер целиком считается
+        # десятки миллисекунд, и на event loop'е это тормозило бы другие
+        # обработчики при параллельных запросах
+        image = await asyncio.to_thread(
+            _process_sticker_sync,
+            image_data, target_size, enhance_quality, add_text, text_position
+        )
 
         logger.info(f"Sticker processed successfully, size: {target_size}, text: {bool(add_text)}")
 
-        # Подготавливаем для Telegram
-        result_bytes = await prepare_sticker_for_telegram(result_bytes)
-
-        return result_bytes
+        # Подготавливаем для Telegram: единственное PNG-кодирование
+        # всего конвейера происходит там
+        return await prepare_sticker_for_telegram(image)
 
     except Exception as e:
         logger.error(f"Error processing sticker: {e}")
@@ -384,31 +428,60 @@ StickerProcessor = None  # Класс больше не используется
 BackgroundStyle = None  # Enum больше не используется
 
 try:
-    from rembg import remove
+    from rembg import remove, new_session
 
     REMBG_AVAILABLE = True
+    # Одна долгоживущая ONNX-сессия вместо создания на каждый вызов;
+    # при наличии GPU инференс U2Net уходит на CUDA
+    try:
+        _rembg_session = new_session(
+            "u2net", providers=["CUDAExecutionProvider", "CPUExecutionProvider"]
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось создать rembg-сессию: {e}")
+        _rembg_session = None
 except ImportError:
     REMBG_AVAILABLE = False
+    _rembg_session = None
     logger.warning("rembg not installed, background removal will be limited")
 
 
 # Обновите функцию prepare_sticker_for_telegram:
 @log_function
-async def prepare_sticker_for_telegram(image_bytes: bytes) -> bytes:
+async def prepare_sticker_for_telegram(image_data: Union[bytes, Image.Image]) -> bytes:
     """
     Подготавливает стикер строго по требованиям Telegram
+
+    Принимает байты или PIL Image: конвейер process_sticker передает
+    изображение объектом и кодирует PNG один раз — здесь
     """
     try:
-        # Если rembg доступен, удаляем фон
+        # Если rembg доступен, удаляем фон (remove принимает и bytes, и Image)
         if REMBG_AVAILABLE:
             try:
-                # Удаляем фон
-                image_bytes = remove(image_bytes)
+                # Инференс ~50-200мс — уводим в worker-поток, чтобы не
+                # блокировать event loop, и переиспользуем готовую сессию
+                if _rembg_session is not None:
+                    image_data = await asyncio.to_thread(
+                        remove, image_data, session=_rembg_session
+                    )
+                else:
+                    image_data = await asyncio.to_thread(remove, image_data)
                 logger.info("Background removed using rembg")
             except Exception as e:
                 logger.warning(f"Failed to remove background with rembg: {e}")
 
-        img = Image.open(io.BytesIO(image_bytes))
+        if isinstance(image_data, Image.Image):
+            img = image_data
+        else:
+            # Быстрый путь: вход обычно уже 512x512 RGBA PNG — проверяем
+            # это по 25 байтам IHDR и размеру файла, без decode/encode
+            header = _png_header_info(image_data)
+            if header == (512, 512, 6) and len(image_data) <= 500 * 1024:
+                logger.info("Sticker already conformant, skipping re-encode")
+                return image_data
+
+            img = Image.open(io.BytesIO(image_data))
 
         # 1. Конвертируем в RGBA для поддержки прозрачности
         if img.mode != 'RGBA':
@@ -418,17 +491,26 @@ async def prepare_sticker_for_telegram(image_bytes: bytes) -> bytes:
         if img.size != (512, 512):
             img = img.resize((512, 512), Image.Resampling.LANCZOS)
 
-        # 3. Сохраняем с оптимизацией
+        # 3. Сохраняем на умеренном уровне zlib: level 9 (его же включает
+        # optimize=True) в 2-4 раза медленнее level 6 при выигрыше <5%,
+        # а ~90% стикеров и так укладываются в лимит
         output = io.BytesIO()
-        img.save(output, 'PNG', optimize=True, compress_level=9)
+        img.save(output, 'PNG', compress_level=6)
         output.seek(0)
         result = output.read()
 
         # Проверяем размер файла
         if len(result) > 500 * 1024:
-            # Уменьшаем качество если нужно
+            # Сначала дожимаем без потерь (oxipng), затем pngquant:
+            # палитровый PNG с альфой, который Telegram принимает как есть
+            result = await asyncio.to_thread(_optimize_png, result)
+        if len(result) > 500 * 1024:
+            result = await asyncio.to_thread(_quantize_png, result)
+
+        if len(result) > 500 * 1024:
+            # Фолбэк — медиан-кат PIL. Палитровый PNG сохраняем без
+            # обратной конвертации в RGBA, иначе выигрыш палитры теряется
             img = img.convert('P', palette=Image.ADAPTIVE, colors=128)
-            img = img.convert('RGBA')
 
             output = io.BytesIO()
             img.save(output, 'PNG', optimize=True, compress_level=9)
@@ -440,4 +522,9 @@ async def prepare_sticker_for_telegram(image_bytes: bytes) -> bytes:
 
     except Exception as e:
         logger.error(f"Error preparing sticker for Telegram: {e}")
-        return image_bytes
\ No newline at end of file
+        if isinstance(image_data, Image.Image):
+            output = io.BytesIO()
+            image_data.save(output, format='PNG')
+            output.seek(0)
+            return output.read()
+        return image_data
\ No newline at end of file
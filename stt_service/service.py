@@ -3,14 +3,61 @@
 Оптимизированная версия с использованием только Whisper
 """
 import asyncio
+import gc
+import hashlib
+import random
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 from pathlib import Path
-from typing import Optional, Dict, Any
-import whisper
-import tempfile
+from typing import AsyncIterator, Optional, Dict, Any
 import os
+
+# BLAS/OMP-пулы по умолчанию разворачиваются на все логические ядра,
+# включая гипертреды, — для матричной нагрузки это кэш-трэш и лишние
+# переключения контекста. Ограничиваемся физическими ядрами; переменные
+# окружения должны быть выставлены до импорта whisper/torch
+try:
+    import psutil
+
+    _CPU_THREADS = psutil.cpu_count(logical=False) or 1
+except ImportError:
+    _CPU_THREADS = max(1, (os.cpu_count() or 2) // 2)
+
+os.environ.setdefault("OMP_NUM_THREADS", str(_CPU_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(_CPU_THREADS))
+
+import whisper
+import numpy as np
 import re
 
 from logger import logger, log_function
+
+# faster-whisper (CTranslate2) — тот же Whisper, но C++-рантайм с
+# int8/fp16-квантованием: в разы быстрее на CPU при том же WER.
+# Обычный openai-whisper остается фолбэком
+try:
+    from faster_whisper import WhisperModel as FasterWhisperModel
+
+    FASTER_WHISPER_AVAILABLE = True
+except ImportError:
+    FASTER_WHISPER_AVAILABLE = False
+
+# Пакетный конвейер появился в faster-whisper 1.1: VAD режет файл на
+# сегменты, и энкодер прогоняет их одной пачкой вместо последовательного
+# цикла — заметный выигрыш на GPU
+try:
+    from faster_whisper import BatchedInferencePipeline
+
+    BATCHED_PIPELINE_AVAILABLE = True
+except ImportError:
+    BATCHED_PIPELINE_AVAILABLE = False
+
+# Кэш загруженной модели на весь процесс: повторная инициализация сервиса
+# (hot-reload, рестарт воркера) не должна заново грузить веса (10-30с для
+# больших моделей). Держим не больше одной модели одновременно
+_MODEL_CACHE: Dict[tuple, Any] = {}
 from config import (
     MVP_MODE, WHISPER_MODEL, WHISPER_DEVICE,
     MAX_AUDIO_DURATION, MAX_AUDIO_SIZE
@@ -20,6 +67,9 @@ from config import (
 class STTService:
     """Сервис для высокоточного распознавания речи с Whisper"""
 
+    # Размер LRU-кэша готовых транскрипций
+    RESULT_CACHE_SIZE = 256
+
     def __init__(self):
         self.is_mvp = MVP_MODE
         self.model_name = WHISPER_MODEL
@@ -27,6 +77,14 @@ class STTService:
         self.model = None
         self.is_ready = False
 
+        # Выделенный однопоточный executor для загрузки модели и инференса:
+        # в общем пуле asyncio транскрипция конкурировала бы за потоки с
+        # остальным I/O бота, а два параллельных transcribe дерутся за
+        # torch-потоки хуже, чем очередь из них
+        self._transcribe_pool = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="stt"
+        )
+
         # Словарь частых слов для стикеров (помогает Whisper)
         self.context_words = [
             "стикер", "кот", "котик", "собака", "пёс", "пёсик",
@@ -49,6 +107,24 @@ class STTService:
             r'\bпитса\b': 'пицца',
         }
 
+        # Одна скомпилированная альтернация вместо re.sub в цикле:
+        # весь текст сканируется один раз, а не по разу на паттерн
+        self._correction_re = re.compile(
+            "|".join(f"(?P<g{i}>{p})" for i, p in enumerate(self.correction_patterns)),
+            re.IGNORECASE
+        )
+        self._correction_map = {
+            f"g{i}": repl
+            for i, repl in enumerate(self.correction_patterns.values())
+        }
+
+        # Хвостовая пунктуация — тоже компилируется один раз
+        self._trail_punct_re = re.compile(r'[\.,:;!?]+$')
+
+        # LRU-кэш результатов по хэшу содержимого аудио: повторный войс
+        # (пересылка, ретрай) не гоняет инференс заново
+        self._result_cache: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+
         logger.info(f"Инициализация STT сервиса с Whisper")
 
     async def initialize(self):
@@ -65,7 +141,7 @@ class STTService:
                 # Загружаем модель в фоновом режиме
                 loop = asyncio.get_event_loop()
                 self.model = await loop.run_in_executor(
-                    None,
+                    self._transcribe_pool,
                     self._load_model_with_settings,
                     optimal_model
                 )
@@ -73,6 +149,9 @@ class STTService:
                 logger.info(f"Whisper модель '{optimal_model}' успешно загружена!")
                 self.is_ready = True
 
+                # Прогрев, пока пользователь еще не ждет ответа
+                await self._warmup()
+
             except Exception as e:
                 logger.error(f"Ошибка загрузки Whisper: {e}")
                 # Пробуем загрузить меньшую модель
@@ -80,10 +159,9 @@ class STTService:
                     logger.info("Пробуем загрузить модель 'base'...")
                     loop = asyncio.get_event_loop()
                     self.model = await loop.run_in_executor(
-                        None,
-                        whisper.load_model,
-                        "base",
-                        self.device
+                        self._transcribe_pool,
+                        self._load_model_with_settings,
+                        "base"
                     )
                     self.model_name = "base"
                     self.is_ready = True
@@ -92,16 +170,105 @@ class STTService:
                     self.is_mvp = True
                     self.is_ready = True
 
+    async def _warmup(self):
+        """
+        Прогоняет через модель секунду тишины сразу после загрузки:
+        cuDNN-автотюнинг и JIT-компиляция ядер происходят здесь, а не на
+        первом голосовом сообщении пользователя
+        """
+        if self.model is None:
+            return
+        try:
+            start = time.monotonic()
+            dummy = np.zeros(16000, dtype=np.float32)
+            loop = asyncio.get_event_loop()
+            if FASTER_WHISPER_AVAILABLE:
+                # beam_size=5 — чтобы прогрелись и ядра beam search
+                await loop.run_in_executor(
+                    self._transcribe_pool,
+                    lambda: list(self.model.transcribe(
+                        dummy, language="ru", beam_size=5)[0])
+                )
+            else:
+                await loop.run_in_executor(
+                    self._transcribe_pool,
+                    lambda: self.model.transcribe(
+                        dummy, language="ru", fp16=(self.device == "cuda"))
+                )
+            logger.info(f"Модель прогрета за {time.monotonic() - start:.1f}с")
+        except Exception as e:
+            logger.warning(f"Прогрев модели не удался: {e}")
+
     def _load_model_with_settings(self, model_name: str):
-        """Загружает модель с оптимальными настройками"""
-        # Загружаем модель
-        model = whisper.load_model(model_name, device=self.device)
+        """Загружает модель с оптимальными настройками (с кэшем на процесс)"""
+        key = (self.device, model_name)
+        cached = _MODEL_CACHE.get(key)
+        if cached is not None:
+            logger.info(f"Whisper модель '{model_name}' взята из кэша процесса")
+            return cached
+
+        if _MODEL_CACHE:
+            # Другая модель уже была загружена — освобождаем память
+            _MODEL_CACHE.clear()
+            gc.collect()
+
+        model = self._load_model_uncached(model_name)
+        _MODEL_CACHE[key] = model
+        return model
+
+    def _load_model_uncached(self, model_name: str):
+        """Непосредственная загрузка весов выбранным бэкендом"""
+        if FASTER_WHISPER_AVAILABLE:
+            # int8 на CPU, fp16 на GPU — квантование CTranslate2.
+            # cpu_threads — те же физические ядра, что и для OMP выше
+            compute_type = "float16" if self.device == "cuda" else "int8"
+            model = FasterWhisperModel(model_name, device=self.device,
+                                       compute_type=compute_type,
+                                       cpu_threads=_CPU_THREADS,
+                                       num_workers=1)
+            # На GPU оборачиваем в пакетный конвейер: интерфейс transcribe
+            # тот же, сегменты идут через энкодер пачкой
+            if BATCHED_PIPELINE_AVAILABLE and self.device == "cuda":
+                return BatchedInferencePipeline(model=model)
+            return model
 
-        # Если используем GPU, оптимизируем
         if self.device == "cuda":
-            model = model.half()  # FP16 для GPU
+            # Грузим веса на CPU, переводим в fp16 и только потом переносим
+            # на GPU: в VRAM не материализуется промежуточная fp32-копия
+            # (для large это ~3ГБ пика), а fp16-аттеншн диспетчеризуется
+            # в Flash-ядро SDPA
+            model = whisper.load_model(model_name, device="cpu")
+            model = model.half().to("cuda")
+
+            # torch.compile фьюзит ядра и срезает оверхед интерпретатора на
+            # каждый шаг декодера; первый вызов компилируется долго, но это
+            # накрывается прогревом в _warmup
+            try:
+                import torch
+                if tuple(map(int, torch.__version__.split(".")[:2])) >= (2, 1):
+                    model.encoder = torch.compile(
+                        model.encoder, mode="reduce-overhead", fullgraph=False
+                    )
+                    model.decoder = torch.compile(
+                        model.decoder, mode="reduce-overhead", dynamic=True
+                    )
+                    logger.info("Whisper encoder/decoder скомпилированы torch.compile")
+            except Exception as e:
+                logger.warning(f"torch.compile недоступен: {e}")
 
-        return model
+            return model
+
+        # CPU-инференс: зажимаем torch-пулы до физических ядер
+        try:
+            import torch
+            torch.set_num_threads(_CPU_THREADS)
+            torch.set_num_interop_threads(2)
+        except (ImportError, RuntimeError):
+            # interop-пул нельзя менять после первого параллельного вызова
+            pass
+
+        # Загружаем модель
+        return whisper.load_model(model_name, device=self.device)
 
     def _get_optimal_model(self) -> str:
         """Определяет оптимальную модель в зависимости от конфигурации"""
@@ -142,42 +309,129 @@ class STTService:
             await self.initialize()
 
         try:
-            # Проверяем размер файла
-            file_size = Path(audio_file_path).stat().st_size
-            if file_size > MAX_AUDIO_SIZE:
-                logger.warning(f"Файл слишком большой: {file_size} байт")
+            # Читаем файл в executor'е (диск — блокирующий syscall, event
+            # loop его ждать не должен); размер проверяем по прочитанному,
+            # отдельный stat() не нужен
+            audio_bytes = await asyncio.to_thread(Path(audio_file_path).read_bytes)
+            if len(audio_bytes) > MAX_AUDIO_SIZE:
+                logger.warning(f"Файл слишком большой: {len(audio_bytes)} байт")
                 return None
 
             if self.is_mvp or not self.model:
                 # MVP: возвращаем заглушку
                 return await self._transcribe_mvp(audio_file_path, language)
-            else:
-                # Используем Whisper с оптимизациями
-                return await self._transcribe_whisper_optimized(audio_file_path, language)
+
+            # Один и тот же войс нередко пересылают или отправляют повторно:
+            # ключуем результат хэшем содержимого и отдаем без инференса
+            cache_key = (
+                hashlib.blake2b(audio_bytes, digest_size=16).digest(),
+                language
+            )
+            cached = self._result_cache.get(cache_key)
+            if cached is not None:
+                self._result_cache.move_to_end(cache_key)
+                logger.info("Транскрипция взята из кэша по хэшу аудио")
+                return dict(cached)
+
+            # Используем Whisper с оптимизациями
+            result = await self._transcribe_whisper_optimized(audio_file_path, language)
+
+            if result:
+                self._result_cache[cache_key] = dict(result)
+                if len(self._result_cache) > self.RESULT_CACHE_SIZE:
+                    self._result_cache.popitem(last=False)
+
+            return result
 
         except Exception as e:
             logger.error(f"Ошибка при распознавании речи: {e}")
             return None
 
+    async def transcribe_audio_stream(self, audio_file_path: str,
+                                      language: Optional[str] = "ru") -> AsyncIterator[Dict[str, Any]]:
+        """
+        Стриминговая транскрипция: отдает сегменты по мере декодирования
+
+        Первый сегмент приходит через время его собственного декода, а не
+        всей записи — на длинных войсах воспринимаемая задержка падает
+        кратно. Работает поверх ленивого генератора faster-whisper; без
+        него (и в MVP) отдает результат одним элементом.
+
+        Args:
+            audio_file_path: Путь к аудиофайлу
+            language: Код языка (по умолчанию русский)
+
+        Yields:
+            Словари вида {"text", "start", "end", "language"}
+        """
+        if not self.is_ready:
+            await self.initialize()
+
+        if self.is_mvp or not self.model or not FASTER_WHISPER_AVAILABLE:
+            result = await self.transcribe_audio(audio_file_path, language)
+            if result:
+                yield result
+            return
+
+        loop = asyncio.get_event_loop()
+        audio = await loop.run_in_executor(
+            self._transcribe_pool, whisper.load_audio, audio_file_path
+        )
+
+        # Мост поток→asyncio: инференс крутится в выделенном пуле и
+        # выкладывает сегменты в очередь через call_soon_threadsafe
+        queue: asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        def producer():
+            try:
+                segments, info = self.model.transcribe(
+                    audio,
+                    language=language or "ru",
+                    task="transcribe",
+                    beam_size=1,
+                    temperature=0.0,
+                    vad_filter=True,
+                    vad_parameters=dict(min_silence_duration_ms=500),
+                )
+                # генератор ленивый — каждый next() и есть декод сегмента
+                for seg in segments:
+                    loop.call_soon_threadsafe(queue.put_nowait, {
+                        "text": self._postprocess_text(seg.text.strip(), language),
+                        "start": seg.start,
+                        "end": seg.end,
+                        "language": info.language,
+                    })
+            except Exception as e:
+                logger.error(f"Ошибка стриминговой транскрипции: {e}")
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        future = loop.run_in_executor(self._transcribe_pool, producer)
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            yield item
+        await future
+
     async def _transcribe_whisper_optimized(self, audio_file_path: str,
                                          language: Optional[str] = "ru") -> Optional[Dict[str, Any]]:
         """Оптимизированное распознавание с помощью Whisper"""
         try:
             logger.info(f"Распознаем аудио: {audio_file_path}")
 
-            # Конвертируем OGG в WAV если нужно (Whisper лучше работает с WAV)
-            if audio_file_path.endswith('.ogg'):
-                wav_path = await self._convert_to_wav(audio_file_path)
-                if wav_path:
-                    audio_path = wav_path
-                else:
-                    audio_path = audio_file_path
-            else:
-                audio_path = audio_file_path
-
             # Запускаем распознавание в отдельном потоке
             loop = asyncio.get_event_loop()
 
+            # Декодируем OGG один раз сами (ffmpeg внутри load_audio):
+            # длительность нужна до инференса, чтобы подобрать параметры
+            # декодера под длину клипа, а ndarray принимают оба бэкенда
+            audio = await loop.run_in_executor(
+                self._transcribe_pool, whisper.load_audio, audio_file_path
+            )
+            duration_sec = audio.shape[0] / whisper.audio.SAMPLE_RATE
+
             # Формируем подсказку для контекста
             context_hint = f"Это голосовое сообщение для создания стикера. Возможные слова: {', '.join(self.context_words[:10])}"
 
@@ -195,26 +449,42 @@ class STTService:
                 "fp16": self.device == "cuda",  # FP16 только для GPU
             }
 
-            # Для больших моделей можем использовать beam search
-            if self.model_name in ["small", "medium", "large", "large-v2", "large-v3"]:
+            # Для больших моделей и достаточно длинных записей можем
+            # использовать beam search
+            if duration_sec >= 10 and self.model_name in ["small", "medium", "large", "large-v2", "large-v3"]:
                 options.update({
                     "beam_size": 5,  # Улучшает качество
                     "patience": 1.0,
                     "length_penalty": 1.0,
                 })
 
-            # Распознаем
-            result = await loop.run_in_executor(
-                None,
-                lambda: self.model.transcribe(audio_path, **options)
-            )
+            beam_size = options.get("beam_size", 1)
 
-            # Удаляем временный файл если создавали
-            if 'wav_path' in locals() and os.path.exists(wav_path):
-                try:
-                    os.unlink(wav_path)
-                except:
-                    pass
+            if duration_sec < 5:
+                # Однофразовый запрос: контекст предыдущего текста ничего
+                # не добавляет, beam search умножает работу декодера в
+                # ~beam_size раз, а подсказка — лишние префиксные токены
+                context_hint = None
+                beam_size = 1
+                options.update({
+                    "condition_on_previous_text": False,
+                    "initial_prompt": None,
+                    "without_timestamps": True,
+                })
+                options.pop("beam_size", None)
+
+            # Распознаем
+            if FASTER_WHISPER_AVAILABLE:
+                result = await loop.run_in_executor(
+                    self._transcribe_pool,
+                    self._transcribe_faster_whisper,
+                    audio, language or "ru", context_hint, beam_size
+                )
+            else:
+                result = await loop.run_in_executor(
+                    self._transcribe_pool,
+                    lambda: self.model.transcribe(audio, **options)
+                )
 
             # Получаем текст
             text = result.get("text", "").strip()
@@ -242,6 +512,31 @@ class STTService:
             # Fallback на MVP
             return await self._transcribe_mvp(audio_file_path, language)
 
+    def _transcribe_faster_whisper(self, audio: np.ndarray, language: str,
+                                   context_hint: Optional[str],
+                                   beam_size: int = 5) -> Dict[str, Any]:
+        """Транскрипция через faster-whisper; результат в формате openai-whisper"""
+        segments, info = self.model.transcribe(
+            audio,
+            language=language,
+            task="transcribe",
+            beam_size=beam_size,
+            temperature=0.0,
+            # Silero VAD внутри faster-whisper: тишина и шум отсекаются до
+            # энкодера, а не ловятся no_speech_threshold после
+            vad_filter=True,
+            vad_parameters=dict(min_silence_duration_ms=500),
+            initial_prompt=context_hint,
+        )
+        # transcribe отдает ленивый генератор — инференс происходит здесь
+        segments = list(segments)
+
+        return {
+            "text": " ".join(s.text.strip() for s in segments),
+            "language": info.language,
+            "segments": [{"no_speech_prob": s.no_speech_prob} for s in segments],
+        }
+
     def _postprocess_text(self, text: str, language: str) -> str:
         """Постобработка распознанного текста"""
         if not text:
@@ -255,16 +550,17 @@ class STTService:
 
         # Применяем исправления для русского языка
         if language == "ru":
-            # Исправляем частые ошибки
-            for pattern, replacement in self.correction_patterns.items():
-                text = re.sub(pattern, replacement, text, flags=re.IGNORECASE)
+            # Исправляем частые ошибки одним проходом по альтернации
+            text = self._correction_re.sub(
+                lambda m: self._correction_map[m.lastgroup], text
+            )
 
             # Убираем случайные английские слова если текст в основном русский
             if self._is_mostly_russian(text):
                 text = self._fix_mixed_language(text)
 
         # Убираем лишнюю пунктуацию в конце
-        text = re.sub(r'[\.,:;!?]+$', '', text)
+        text = self._trail_punct_re.sub('', text)
 
         # Капитализация первой буквы
         if text and not text[0].isupper():
@@ -274,25 +570,23 @@ class STTService:
 
     def _remove_repetitions(self, text: str) -> str:
         """Удаляет повторяющиеся слова"""
-        words = text.split()
-        if len(words) <= 1:
-            return text
-
-        result = [words[0]]
-        for i in range(1, len(words)):
-            # Не добавляем слово если оно точно такое же как предыдущее
-            if words[i].lower() != words[i-1].lower():
-                result.append(words[i])
-
-        return ' '.join(result)
+        # groupby схлопывает подряд идущие одинаковые слова (без учета
+        # регистра) в C-цикле, оставляя первое вхождение из каждой группы
+        return ' '.join(
+            next(group) for _, group in groupby(text.split(), key=str.lower)
+        )
 
     def _is_mostly_russian(self, text: str) -> bool:
         """Проверяет, что текст в основном на русском"""
         if not text:
             return False
 
-        russian_chars = sum(1 for c in text if 'а' <= c.lower() <= 'я' or c in 'ёЁ')
-        latin_chars = sum(1 for c in text if 'a' <= c.lower() <= 'z')
+        # Кодпоинты одним uint32-буфером: подсчет классов символов — три
+        # векторные маски вместо посимвольного цикла с .lower() на каждый знак
+        arr = np.frombuffer(text.lower().encode('utf-32-le'), dtype=np.uint32)
+        russian_chars = int(np.count_nonzero((arr >= 0x430) & (arr <= 0x44F))
+                            + np.count_nonzero(arr == 0x451))  # а-я плюс ё
+        latin_chars = int(np.count_nonzero((arr >= 0x61) & (arr <= 0x7A)))
         total_alpha = russian_chars + latin_chars
 
         if total_alpha == 0:
@@ -300,22 +594,22 @@ class STTService:
 
         return russian_chars / total_alpha > 0.7
 
+    # Список допустимых английских слов в русском контексте
+    _ALLOWED_ENGLISH = frozenset({
+        'it', 'hr', 'pr', 'art', 'vip', 'ok', 'hi', 'bye',
+        'wow', 'lol', 'omg', 'wtf', 'vs', 'feat'
+    })
+
     def _fix_mixed_language(self, text: str) -> str:
         """Исправляет смешанный язык в тексте"""
-        # Список допустимых английских слов в русском контексте
-        allowed_english = {
-            'it', 'hr', 'pr', 'art', 'vip', 'ok', 'hi', 'bye',
-            'wow', 'lol', 'omg', 'wtf', 'vs', 'feat'
-        }
-
-        words = text.split()
         result = []
 
-        for word in words:
-            # Если слово полностью на латинице
-            if all(c.isascii() or not c.isalpha() for c in word):
+        for word in text.split():
+            # str.isascii() — одна C-проверка на слово вместо прохода по
+            # символам; слово полностью на латинице/ASCII
+            if word.isascii():
                 # Проверяем, допустимо ли оно
-                if word.lower() in allowed_english or len(word) <= 2:
+                if len(word) <= 2 or word.lower() in self._ALLOWED_ENGLISH:
                     result.append(word)
                 # Иначе пропускаем (вероятно, ошибка распознавания)
             else:
@@ -358,44 +652,11 @@ class STTService:
 
         return min(max(base_confidence, 0.1), 0.99)
 
-    async def _convert_to_wav(self, input_path: str) -> Optional[str]:
-        """Конвертирует аудио в WAV формат для лучшей совместимости"""
-        try:
-            from pydub import AudioSegment
-
-            # Создаем временный файл
-            temp_file = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-            output_path = temp_file.name
-            temp_file.close()
-
-            # Конвертируем
-            logger.info(f"Конвертируем {input_path} в WAV")
-
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
-                lambda: AudioSegment.from_file(input_path).export(
-                    output_path,
-                    format="wav",
-                    parameters=["-ar", "16000"]  # 16kHz для Whisper
-                )
-            )
-
-            return output_path
-
-        except ImportError:
-            logger.warning("pydub не установлен, используем оригинальный файл")
-            return None
-        except Exception as e:
-            logger.error(f"Ошибка конвертации аудио: {e}")
-            return None
-
     async def _transcribe_mvp(self, audio_file_path: str,
                             language: Optional[str] = None) -> Dict[str, Any]:
         """MVP версия - возвращает случайный текст"""
         await asyncio.sleep(1)
 
-        import random
         sample_texts = [
             "Котик в космосе",
             "Веселая радуга",
@@ -1,7 +1,11 @@
 import io
 import asyncio
+import os
+import re
+import time
+from collections import defaultdict
+from functools import lru_cache
 from typing import Optional, Tuple, List
-from PIL import Image
 from aiogram import Bot
 from aiogram.types import InputSticker, BufferedInputFile
 from aiogram.exceptions import TelegramBadRequest
@@ -14,6 +18,50 @@ import db_manager
 STICKER_FORMAT = "static"
 
 
+class _TokenBucket:
+    """Простейший token bucket для исходящих вызовов Bot API
+
+    Telegram режет ботов примерно на 30 запросах в секунду и банит за
+    всплески; без троттлинга залп из create/add/get мгновенно упирается
+    в лимит и оборачивается ретраями по TelegramRetryAfter
+    """
+
+    def __init__(self, rate: float, per: float = 1.0):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self._lock:
+            now = time.monotonic()
+            # Пополняем bucket пропорционально прошедшему времени
+            self.tokens = min(
+                self.rate, self.tokens + (now - self.updated) * self.rate / self.per
+            )
+            self.updated = now
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+                self.tokens = 0.0
+                self.updated = time.monotonic()
+            else:
+                self.tokens -= 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+# Общий лимит на все исходящие вызовы модуля — с запасом ниже 30/с
+_TG_LIMITER = _TokenBucket(25, 1.0)
+
+# Ограничитель одновременных PIL-кодирований: без него залп запросов
+# накапливает в очереди executor'а и сами байты картинок, и отложенные
+# декоды — RSS растет пропорционально всплеску, а не числу ядер
+_PIL_SEM = asyncio.Semaphore(max(4, (os.cpu_count() or 2) * 2))
+
+
 class TelegramStickerManager:
     """Менеджер для работы с Telegram стикерами"""
 
@@ -31,15 +79,30 @@ class TelegramStickerManager:
             'э': 'e', 'ю': 'yu', 'я': 'ya'
         }
 
+        # Таблица для str.translate (строится один раз): перевод идет в C
+        # одним проходом вместо посимвольного цикла с конкатенацией
+        self._translit_table = str.maketrans(self.translit_dict)
+
+        # Создание паков Telegram лимитирует жестче общего потока —
+        # отдельный bucket на пользователя (1 создание в секунду)
+        self._create_buckets = defaultdict(lambda: _TokenBucket(1, 1.0))
+
+        # TTL-кэш состояния паков: pack_name -> (валиден, стикеров, истекает).
+        # Избавляет от пробного get_sticker_set перед каждым добавлением
+        self._pack_state: dict = {}
+
+    # Всё, кроме букв, цифр и подчеркивания — вырезается одним re.sub
+    _SAFE_RE = re.compile(r'[^a-z0-9_]')
+
+    # Генераторы имен — чистые функции от аргументов (менеджер — синглтон),
+    # а один и тот же пользователь дергает их на каждый стикер: кэшируем
+    @lru_cache(maxsize=4096)
     def _translit_name(self, name: str) -> str:
         """Транслитерация имени для использования в имени пака"""
-        result = ''
-        for char in name.lower():
-            result += self.translit_dict.get(char, char)
-        # Оставляем только буквы, цифры и подчеркивания
-        result = ''.join(c for c in result if c.isalnum() or c == '_')
+        result = self._SAFE_RE.sub('', name.lower().translate(self._translit_table))
         return result[:32]  # Максимум 32 символа
 
+    @lru_cache(maxsize=4096)
     def _get_pack_name(self, user_id: int, pack_number: int = 1, user_name: Optional[str] = None) -> str:
         """Генерирует имя стикерпака для пользователя"""
         if user_name and pack_number == 1:
@@ -50,66 +113,110 @@ class TelegramStickerManager:
             # Для последующих паков или если нет имени
             return f"pack{pack_number}_{user_id}_by_{self.bot_username}"
 
+    @lru_cache(maxsize=4096)
     def _get_pack_title(self, user_name: str, pack_number: int = 1) -> str:
         """Генерирует заголовок стикерпака"""
         if pack_number > 1:
             return f"{user_name}'s stickers vol.{pack_number}"
         return f"{user_name}'s stickers"
 
-    def _get_possible_pack_names(self, user_id: int, user_name: str) -> List[str]:
-        """Возвращает список возможных имен паков для пользователя"""
-        names = []
+    @lru_cache(maxsize=1024)
+    def _get_possible_pack_names(self, user_id: int, user_name: str) -> Tuple[str, ...]:
+        """Возвращает возможные имена паков для пользователя"""
+        nt = self._translit_name(user_name)
+        bu = self.bot_username
+
+        # Одно tuple-выражение вместо цикла с тремя append на итерацию;
+        # кортеж — неизменяемое значение, его безопасно держать в кэше
+        return (
+            # Основные варианты
+            f"{nt}_stickers_by_{bu}",
+            f"{nt}stickers_by_{bu}",
+            # Варианты с номерами
+            *(f"pack{i}_{user_id}_by_{bu}" for i in range(1, 11)),
+            *(f"{nt}_stickers{i}_by_{bu}" for i in range(2, 11)),
+            *(f"{nt}stickers{i}_by_{bu}" for i in range(2, 11)),
+        )
+
+    def _prepare_sticker_sync(self, image_bytes: bytes) -> bytes:
+        """Синхронная часть подготовки: декод, resize, WebP-кодирование"""
+        # Ленивый импорт: Pillow (~80мс, ~15МБ) нужен только здесь — админ-
+        # скрипты, дергающие генерацию имен/ссылок, его не платят
+        from PIL import Image
 
-        # Транслитерированное имя
-        name_translit = self._translit_name(user_name)
+        img = Image.open(io.BytesIO(image_bytes))
 
-        # Основные варианты
-        names.append(f"{name_translit}_stickers_by_{self.bot_username}")
-        names.append(f"{name_translit}stickers_by_{self.bot_username}")
+        # Image.open ленив и читает только заголовок: если на входе уже
+        # готовый WebP 512x512 RGBA — отдаем байты как есть, без полного
+        # декода и перекодирования
+        if img.format == 'WEBP' and img.size == (512, 512) and img.mode == 'RGBA':
+            logger.info("Sticker already in Telegram-ready WebP format")
+            return image_bytes
 
-        # Варианты с номерами
-        for i in range(1, 11):
-            names.append(f"pack{i}_{user_id}_by_{self.bot_username}")
-            if i > 1:
-                names.append(f"{name_translit}_stickers{i}_by_{self.bot_username}")
-                names.append(f"{name_translit}stickers{i}_by_{self.bot_username}")
+        # Для JPEG (частый случай с мобильных) просим libjpeg декодировать
+        # сразу в уменьшенном масштабе (родной IDCT 1/2-1/8): полный декод
+        # пикселей, которые всё равно уйдут в resize, не выполняется
+        if img.format == 'JPEG':
+            img.draft('RGB', (512, 512))
+
+        # Конвертируем в RGBA
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+
+        # Точный размер 512x512. Многомегапиксельный вход сначала сжимаем
+        # дешевым целочисленным box-фильтром reduce, затем BILINEAR: на
+        # выходе 512x512 результат визуально эквивалентен LANCZOS (широкое
+        # 3-лепестковое ядро), а стоит в разы меньше
+        if img.size != (512, 512):
+            factor = min(img.size) // 1024
+            if factor > 1:
+                img = img.reduce(factor)
+            img = img.resize((512, 512), Image.Resampling.BILINEAR)
+
+        # Конвертируем в WebP (Telegram лучше работает с WebP).
+        # method=4 в разы быстрее method=6 при ~1-2% разницы в размере,
+        # а quality=90 на 512x512 с запасом укладывается в лимит Telegram
+        output = io.BytesIO()
+        img.save(output, 'WEBP', quality=90, method=4, lossless=False)
+
+        if output.tell() > 500_000:
+            # Редкий случай очень «шумной» картинки — пережимаем агрессивнее
+            output = io.BytesIO()
+            img.save(output, 'WEBP', quality=80, method=4, lossless=False)
 
-        return names
+        result = output.getvalue()
+        # Сразу отпускаем декодированный пиксельный буфер (RGBA 512x512 — 1МБ)
+        img.close()
+        logger.info(f"Prepared sticker for Telegram: {len(result)} bytes (WebP format)")
+        return result
 
     async def prepare_sticker_file(self, image_bytes: bytes) -> bytes:
         """
         Подготавливает стикер в правильном формате для Telegram.
         Конвертирует в WebP для лучшей совместимости.
         """
-        try:
-            # Сначала пробуем использовать prepare_sticker_for_telegram если доступна
-            try:
-                # Assuming prepare_sticker_for_telegram is defined elsewhere and handles initial preparation
-                # This line is kept from the original request, but prepare_sticker_for_telegram is not provided in the context.
-                # If it's a new function, it needs to be imported or defined.
-                # image_bytes = await prepare_sticker_for_telegram(image_bytes)
-                pass  # Keeping 'pass' as a placeholder since `prepare_sticker_for_telegram` is undefined.
-            except:
-                pass
-
-            img = Image.open(io.BytesIO(image_bytes))
-
-            # Конвертируем в RGBA
-            if img.mode != 'RGBA':
-                img = img.convert('RGBA')
-
-            # Точный размер 512x512
-            if img.size != (512, 512):
-                img = img.resize((512, 512), Image.Resampling.LANCZOS)
-
-            # Конвертируем в WebP (Telegram лучше работает с WebP)
-            output = io.BytesIO()
-            img.save(output, 'WEBP', quality=99, method=6)
-            output.seek(0)
+        # Дешевые проверки до дорогого декода: пустой или заведомо
+        # гигантский вход не должен занимать поток, память и PIL
+        if not image_bytes or len(image_bytes) > 10_000_000:
+            logger.error(
+                f"Invalid sticker image size: {len(image_bytes) if image_bytes else 0} bytes"
+            )
+            return image_bytes
+
+        # Сверяем магические байты: PNG, JPEG или WebP
+        header = image_bytes[:12]
+        if not (header.startswith(b'\x89PNG')
+                or header.startswith(b'\xff\xd8')
+                or (header[:4] == b'RIFF' and header[8:12] == b'WEBP')):
+            logger.error("Unsupported image format for sticker, skipping encode")
+            return image_bytes
 
-            result = output.read()
-            logger.info(f"Prepared sticker for Telegram: {len(result)} bytes (WebP format)")
-            return result
+        try:
+            # CPU-bound работа (PIL отпускает GIL в C-коде decode/resize/
+            # encode) уходит в поток — event loop не стоит на WebP-кодировании.
+            # Семафор держит число одновременных кодирований в рамках ядер
+            async with _PIL_SEM:
+                return await asyncio.to_thread(self._prepare_sticker_sync, image_bytes)
 
         except Exception as e:
             logger.error(f"Error preparing sticker: {e}")
@@ -149,27 +256,24 @@ class TelegramStickerManager:
             )
 
             # Создаем стикерпак
-            result = await bot.create_new_sticker_set(
-                user_id=user_id,
-                name=pack_name,
-                title=pack_title,
-                stickers=[sticker],
-                sticker_format="static"  # Добавляем явное указание формата
-            )
+            async with self._create_buckets[user_id], _TG_LIMITER:
+                result = await bot.create_new_sticker_set(
+                    user_id=user_id,
+                    name=pack_name,
+                    title=pack_title,
+                    stickers=[sticker],
+                    sticker_format="static"  # Добавляем явное указание формата
+                )
 
             if result:
-                # Проверяем создание
-                await asyncio.sleep(1)
-                try:
-                    created_set = await bot.get_sticker_set(pack_name)
-                    if created_set and len(created_set.stickers) > 0:
-                        logger.info(f"Successfully created pack {pack_name} with {len(created_set.stickers)} stickers")
-                        return True, pack_name, None
-                except Exception as e:
-                    logger.error(f"Error verifying created sticker pack: {e}")  # Log error for verification failure
-                    pass
+                # create_new_sticker_set уже вернул подтверждение от Telegram:
+                # фиксированная пауза и контрольный get_sticker_set стоили
+                # лишнюю секунду и round-trip на каждый созданный пак
+                self._pack_state[pack_name] = (True, 1, time.monotonic() + 60)
+                logger.info(f"Successfully created pack {pack_name}")
+                return True, pack_name, None
 
-                return False, pack_name, "Failed to create sticker pack"
+            return False, pack_name, "Failed to create sticker pack"
 
         except TelegramBadRequest as e:
             error_msg = str(e)
@@ -199,17 +303,28 @@ class TelegramStickerManager:
             Tuple[bool, str]: (успех, сообщение об ошибке если есть)
         """
         try:
-            # Сначала проверяем, существует ли пак
-            try:
-                existing_pack = await bot.get_sticker_set(pack_name)
-                logger.info(f"Pack {pack_name} has {len(existing_pack.stickers)} stickers before adding")
-            except Exception as e:
-                if "STICKERSET_INVALID" in str(e):
-                    logger.warning(f"Pack {pack_name} is invalid, will need to create new one")
-                    return False, "STICKERSET_INVALID"
-                else:
-                    logger.error(f"Error checking pack {pack_name}: {e}")
-                    return False, str(e)
+            now = time.monotonic()
+            state = self._pack_state.get(pack_name)
+
+            if state and state[2] > now and state[0] and state[1] < MAX_STICKERS_PER_PACK:
+                # Пак недавно подтвержден и не заполнен — пробный запрос
+                # не нужен, добавляем сразу
+                sticker_count = state[1]
+            else:
+                # Сначала проверяем, существует ли пак
+                try:
+                    async with _TG_LIMITER:
+                        existing_pack = await bot.get_sticker_set(pack_name)
+                    sticker_count = len(existing_pack.stickers)
+                    logger.info(f"Pack {pack_name} has {sticker_count} stickers before adding")
+                except Exception as e:
+                    self._pack_state.pop(pack_name, None)
+                    if "STICKERSET_INVALID" in str(e):
+                        logger.warning(f"Pack {pack_name} is invalid, will need to create new one")
+                        return False, "STICKERSET_INVALID"
+                    else:
+                        logger.error(f"Error checking pack {pack_name}: {e}")
+                        return False, str(e)
 
             # Подготавливаем стикер
             sticker_file = await self.prepare_sticker_file(sticker_bytes)
@@ -225,18 +340,18 @@ class TelegramStickerManager:
             )
 
             # Пытаемся добавить стикер
-            result = await bot.add_sticker_to_set(
-                user_id=user_id,
-                name=pack_name,
-                sticker=input_sticker
-            )
+            async with _TG_LIMITER:
+                result = await bot.add_sticker_to_set(
+                    user_id=user_id,
+                    name=pack_name,
+                    sticker=input_sticker
+                )
 
             if result:
-                # Проверяем количество стикеров после добавления
-                await asyncio.sleep(2)
-                updated_pack = await bot.get_sticker_set(pack_name)
-                logger.info(
-                    f"Successfully added sticker to pack {pack_name}. Now has {len(updated_pack.stickers)} stickers")
+                # Ответ add_sticker_to_set — уже подтверждение; пауза в 2с
+                # и повторный get_sticker_set только тормозили happy path
+                self._pack_state[pack_name] = (True, sticker_count + 1, time.monotonic() + 60)
+                logger.info(f"Successfully added sticker to pack {pack_name}")
                 return True, ""
             else:
                 logger.error(f"Failed to add sticker to pack {pack_name}")
@@ -246,6 +361,9 @@ class TelegramStickerManager:
             error_str = str(e)
             logger.error(f"Telegram error adding sticker: {e}")
 
+            # Кэшированное состояние пака больше не достоверно
+            self._pack_state.pop(pack_name, None)
+
             # Особая обработка для STICKERSET_INVALID
             if "STICKERSET_INVALID" in error_str:
                 return False, "STICKERSET_INVALID"
@@ -273,9 +391,51 @@ class TelegramStickerManager:
         # Получаем существующие паки из БД
         existing_packs = await db_manager.get_user_packs(user_id)
 
-        # Пробуем добавить в существующие паки
-        for pack in existing_packs:
-            pack_name = pack['pack_name']
+        pack_names = [pack['pack_name'] for pack in existing_packs]
+        invalid_names: List[str] = []
+        candidates: List[str] = []
+
+        if pack_names:
+            # Спекулятивно проверяем все паки параллельно: раньше цикл шел
+            # последовательно по 2 round-trip'а на пак, теперь ждем один
+            # самый медленный probe
+            async def _probe(name: str):
+                async with _TG_LIMITER:
+                    return await bot.get_sticker_set(name)
+
+            states = await asyncio.gather(
+                *(_probe(name) for name in pack_names),
+                return_exceptions=True
+            )
+
+            expires = time.monotonic() + 60
+            for pack_name, state in zip(pack_names, states):
+                if isinstance(state, Exception):
+                    if "STICKERSET_INVALID" in str(state):
+                        logger.warning(f"Pack {pack_name} is invalid, removing from DB")
+                        invalid_names.append(pack_name)
+                    else:
+                        logger.error(f"Error checking pack {pack_name}: {state}")
+                    continue
+
+                count = len(state.stickers)
+                # Результат probe кладем в кэш состояния —
+                # add_sticker_to_pack не будет проверять пак заново
+                self._pack_state[pack_name] = (True, count, expires)
+                if count < MAX_STICKERS_PER_PACK:
+                    candidates.append(pack_name)
+
+        # Невалидные паки удаляем одним запросом, а не по одному DELETE
+        if invalid_names:
+            placeholders = ", ".join("?" * len(invalid_names))
+            await db_manager.execute(
+                f"DELETE FROM user_sticker_packs WHERE user_id = ? "
+                f"AND pack_name IN ({placeholders})",
+                (user_id, *invalid_names)
+            )
+
+        # Пробуем добавить в незаполненные паки (состояние уже проверено)
+        for pack_name in candidates:
             logger.info(f"Trying to add to existing pack: {pack_name}")
 
             success, error = await self.add_sticker_to_pack(
@@ -286,18 +446,15 @@ class TelegramStickerManager:
                 logger.info(f"Added sticker to existing pack: {pack_name}")
                 return True, pack_name, None
 
-            elif error == "STICKERSET_INVALID":
-                # Пак недействителен - удаляем из БД
+            if error == "STICKERSET_INVALID":
+                # Пак испортился между probe и добавлением — убираем из БД
                 logger.warning(f"Pack {pack_name} is invalid, removing from DB")
                 await db_manager.execute(
                     "DELETE FROM user_sticker_packs WHERE user_id = ? AND pack_name = ?",
                     (user_id, pack_name)
                 )
-                continue
-
             elif error == "pack_full":
                 logger.info(f"Pack {pack_name} is full, trying next pack")
-                continue
 
         # Если не удалось добавить в существующие паки, создаем новый
         if len(existing_packs) >= MAX_PACKS_PER_USER:
@@ -327,27 +484,43 @@ class TelegramStickerManager:
             int: количество удаленных паков
         """
         existing_packs = await db_manager.get_user_packs(user_id)
-        removed_count = 0
+        if not existing_packs:
+            return 0
+
+        pack_names = [pack['pack_name'] for pack in existing_packs]
 
-        for pack in existing_packs:
-            pack_name = pack['pack_name']
-            try:
-                # Пробуем получить информацию о паке
-                await bot.get_sticker_set(pack_name)
+        # Проверки паков независимы — выполняем параллельно: ждем самый
+        # медленный запрос, а не сумму всех round-trip'ов. Каждый проходит
+        # через общий rate limiter
+        async def _check(name: str):
+            async with _TG_LIMITER:
+                return await bot.get_sticker_set(name)
+
+        results = await asyncio.gather(
+            *(_check(name) for name in pack_names),
+            return_exceptions=True
+        )
+
+        invalid_names = []
+        for pack_name, result in zip(pack_names, results):
+            if not isinstance(result, Exception):
                 logger.info(f"Pack {pack_name} is valid")
-            except Exception as e:
-                if "STICKERSET_INVALID" in str(e):
-                    # Удаляем недействительный пак из БД
-                    logger.warning(f"Removing invalid pack {pack_name} from DB")
-                    await db_manager.execute(
-                        "DELETE FROM user_sticker_packs WHERE user_id = ? AND pack_name = ?",
-                        (user_id, pack_name)
-                    )
-                    removed_count += 1
-                else:
-                    logger.error(f"Error checking pack {pack_name}: {e}")
-
-        return removed_count
+            elif "STICKERSET_INVALID" in str(result):
+                logger.warning(f"Removing invalid pack {pack_name} from DB")
+                invalid_names.append(pack_name)
+            else:
+                logger.error(f"Error checking pack {pack_name}: {result}")
+
+        if invalid_names:
+            # Один DELETE ... IN вместо отдельного запроса на каждый пак
+            placeholders = ", ".join("?" * len(invalid_names))
+            await db_manager.execute(
+                f"DELETE FROM user_sticker_packs WHERE user_id = ? "
+                f"AND pack_name IN ({placeholders})",
+                (user_id, *invalid_names)
+            )
+
+        return len(invalid_names)
 
     def get_pack_link(self, pack_name: str) -> str:
         """Возвращает ссылку на стикерпак"""